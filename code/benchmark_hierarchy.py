@@ -0,0 +1,148 @@
+"""
+Benchmarks the construction of the bi-stride hierarchy, time and peak memory per
+level on synthetic grids of growing size and on the meshes of a cylinder_flow h5
+file, and optionally the clustering, seeding and BFS steps on their own.
+
+    python benchmark_hierarchy.py -sizes 2000 50000 -h5 ../data/cylinder_flow/train.h5
+"""
+
+import argparse
+import sys
+import time
+import tracemalloc
+
+import h5py
+import numpy as np
+import scipy
+
+from dataprocessing.utils.helper_pooling import (
+    _BFS_dist,
+    _find_clusters,
+    _min_ave_seed,
+    bstride_selection,
+)
+from dataprocessing.utils.triangle_to_edges import triangles_to_edges
+
+
+def grid_mesh(n_nodes):
+    """
+    Triangulated square grid with about n_nodes nodes.
+
+    Returns:
+      (np.ndarray, np.ndarray): The two-way edges [2, E] and the node positions [N, 2].
+    """
+    side = max(int(np.sqrt(n_nodes)), 2)
+    ids = np.arange(side * side).reshape(side, side)
+    a, b = ids[:-1, :-1].ravel(), ids[:-1, 1:].ravel()
+    c, d = ids[1:, :-1].ravel(), ids[1:, 1:].ravel()
+    cells = np.concatenate([np.stack([a, b, d], 1), np.stack([a, d, c], 1)])
+    xx, yy = np.meshgrid(np.arange(side), np.arange(side))
+    pos = np.stack([xx.ravel(), yy.ravel()], 1).astype(np.float32)
+    return np.stack(triangles_to_edges(cells)), pos
+
+
+def h5_meshes(h5_file, trajectories):
+    """Yields the name, edges [2, E] and node positions [N, 2] of h5 trajectories"""
+    with h5py.File(h5_file, "r") as data:
+        for t in trajectories or list(data.keys())[:2]:
+            edges = np.stack(triangles_to_edges(data[t]["cells"][0]))
+            yield f"{t}", edges, data[t]["pos"][0]
+
+
+def measure(fn, *args, **kwargs):
+    """Returns the result, the wall time in seconds and the peak traced memory in MB"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    res = fn(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return res, elapsed, peak / 2**20
+
+
+def adjacency(edges, n_nodes):
+    return scipy.sparse.csr_array(
+        (np.ones(edges.shape[1]), (edges[0], edges[1])), shape=(n_nodes, n_nodes)
+    )
+
+
+def all_pairs_seed(adj, clusters):
+    # the previous seeding from the full depth matrix, kept as reference
+    dist = scipy.sparse.csgraph.shortest_path(adj, method="D", unweighted=True)
+    return [c[np.argmin(np.sum(dist[c][:, c], axis=1))] for c in clusters]
+
+
+def bench_seeding(n_nodes, max_dense):
+    edges, pos = grid_mesh(n_nodes)
+    n = len(pos)
+    adj = adjacency(edges, n)
+    clusters, elapsed, peak = measure(_find_clusters, adj)
+    rows = [(n, "clusters", elapsed, peak, len(clusters))]
+    methods = {
+        "landmark": lambda: _min_ave_seed(adj, clusters, max_exact=0),
+        "centroid": lambda: _min_ave_seed(adj, clusters, pos, max_exact=0),
+    }
+    if n <= max_dense:
+        methods["exact"] = lambda: _min_ave_seed(adj, clusters)
+        methods["all_pairs"] = lambda: all_pairs_seed(adj, clusters)
+    for name, fn in methods.items():
+        seeds, elapsed, peak = measure(fn)
+        rows.append((n, name, elapsed, peak, [int(s) for s in seeds]))
+    # the BFS that splits the clusters into odd and even depths
+    depth, elapsed, peak = measure(_BFS_dist, adj, seeds)
+    rows.append((n, "bfs", elapsed, peak, int(depth[0][depth[0] < n].max())))
+    return rows
+
+
+def bench_levels(edges, pos, num_l):
+    """
+    Builds num_l levels as generate_multi_layer_stride does, and returns the
+    nodes, edges, time and peak memory of each level.
+    """
+    rows = []
+    g, n_l = edges, len(pos)
+    for layer in range(num_l):
+        (index_to_keep, g, _), elapsed, peak = measure(
+            bstride_selection, g, n_nodes=n_l, pos_mesh=pos
+        )
+        rows.append((layer, n_l, elapsed, peak))
+        pos, n_l = pos[index_to_keep], len(index_to_keep)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-sizes", type=int, nargs="+", default=[500, 2000, 10000, 50000, 200000]
+    )
+    parser.add_argument("-levels", type=int, default=4)
+    parser.add_argument("-h5", type=str, default=None, help="cylinder_flow h5 file")
+    parser.add_argument("-trajectories", type=str, nargs="+", default=None)
+    parser.add_argument(
+        "-seeding",
+        action="store_true",
+        help="Also benchmark clustering, seeding and BFS on their own",
+    )
+    parser.add_argument(
+        "-max_dense",
+        type=int,
+        default=2000,
+        help="Largest mesh to also seed exactly and by the all-pairs matrix",
+    )
+    args = parser.parse_args()
+    meshes = [(f"grid_{size}", *grid_mesh(size)) for size in args.sizes]
+    if args.h5 is not None:
+        meshes += list(h5_meshes(args.h5, args.trajectories))
+    print(f"{'mesh':>12} {'level':>6} {'nodes':>8} {'time [s]':>10} {'peak [MB]':>10}")
+    for name, edges, pos in meshes:
+        total = 0
+        for layer, n, elapsed, peak in bench_levels(edges, pos, args.levels):
+            total += elapsed
+            print(f"{name:>12} {layer:>6} {n:>8} {elapsed:>10.3f} {peak:>10.1f}")
+        print(f"{name:>12} {'total':>6} {len(pos):>8} {total:>10.3f}")
+    if not args.seeding:
+        sys.exit(0)
+    print(f"{'nodes':>8} {'step':>10} {'time [s]':>10} {'peak [MB]':>10}  result")
+    for size in args.sizes:
+        for n, name, elapsed, peak, res in bench_seeding(size, args.max_dense):
+            print(f"{n:>8} {name:>10} {elapsed:>10.3f} {peak:>10.1f}  {res}")
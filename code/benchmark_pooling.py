@@ -0,0 +1,93 @@
+"""
+Benchmarks the pooling of the encoder, the forward and backward time of every
+Res_down layer with TopKPooling and with the bi-stride hierarchy, on batches of a
+converted dataset.
+
+    python benchmark_pooling.py -data_dir ../data/cylinder_flow/trajectories_1768
+"""
+
+import argparse
+import time
+
+import torch
+from torch_geometric.loader import DataLoader
+
+from dataprocessing.dataset import load_mesh_datasets
+from model.encoder import Encoder
+from utils.helperfuncs import merge_dataset_stats
+
+
+def synchronize(device):
+    if device == "cuda":
+        torch.cuda.synchronize()
+
+
+def bench_encoder(encoder, batches, device):
+    """
+    Runs the Res_down layers of encoder on every batch, and returns the nodes after
+    and the mean forward time in seconds of each layer, and the mean backward time
+    through all of them.
+    """
+    n_layers = len(encoder.layers)
+    forward, nodes, backward = [0.0] * n_layers, [0] * n_layers, 0.0
+    for b_data in batches:
+        b_data = b_data.clone().to(device)
+        b_data.x = encoder.node_encoder(b_data.x)
+        for i, layer in enumerate(encoder.layers):
+            synchronize(device)
+            start = time.perf_counter()
+            b_data = layer(b_data)
+            synchronize(device)
+            forward[i] += time.perf_counter() - start
+            nodes[i] = b_data.x.shape[-2]
+        start = time.perf_counter()
+        b_data.x.sum().backward()
+        synchronize(device)
+        backward += time.perf_counter() - start
+    n = len(batches)
+    return [(i, nodes[i], forward[i] / n) for i in range(n_layers)], backward / n
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-data_dir", type=str, default="../data/cylinder_flow/trajectories_1768"
+    )
+    parser.add_argument("-batch_sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("-batches", type=int, default=10)
+    parser.add_argument("-ae_layers", type=int, default=3)
+    parser.add_argument("-hidden_dim", type=int, default=32)
+    parser.add_argument("-num_workers", type=int, default=1)
+    args = parser.parse_args()
+    # The model settings of runscripts/run.py
+    args.device = "cuda" if torch.cuda.is_available() else "cpu"
+    args.dataset_manifest = True
+    args.batch_norm = True
+    args.edge_conv = True
+    args.latent_dim = 64
+    args.mpl_layers = 2
+    args.mpl_ratio = 0.3
+    args.num_blocks = 2
+    args.pool_strat = "TopK"
+
+    train_data, test_data, val_data = load_mesh_datasets(args)
+    args.in_dim_node = train_data[0].num_features
+    args.in_dim_edge = train_data[0].edge_attr.shape[1]
+    hierarchies, args.max_latent_nodes, args.max_latent_edges, _ = merge_dataset_stats(
+        train_data, test_data, val_data
+    )
+    print(f"{'pool':>10} {'batch':>6} {'layer':>6} {'nodes':>8} {'time [s]':>10}")
+    for batch_size in args.batch_sizes:
+        loader = DataLoader(train_data, batch_size=batch_size, shuffle=True)
+        batches = [b for b, _ in zip(loader, range(args.batches))]
+        for bi_stride_pool, name in ((False, "topk"), (True, "bi_stride")):
+            args.batch_size = batch_size
+            args.bi_stride_pool = bi_stride_pool
+            torch.manual_seed(0)
+            encoder = Encoder(args, hierarchies).to(args.device)
+            # Untimed, fills the batch_level and interpolation caches
+            bench_encoder(encoder, batches[:1], args.device)
+            layers, backward = bench_encoder(encoder, batches, args.device)
+            for layer, n, elapsed in layers:
+                print(f"{name:>10} {batch_size:>6} {layer:>6} {n:>8} {elapsed:>10.4f}")
+            print(f"{name:>10} {batch_size:>6} {'back':>6} {'':>8} {backward:>10.4f}")
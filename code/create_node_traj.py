@@ -1,15 +1,22 @@
+import os
+
 from dataprocessing.utils.loading import (
     constructDatasetFolders,
     extend_node_attributes,
     find_trajectory_nodes,
 )
+from dataprocessing.utils.packing import pack_dataset
 from loguru import logger
 
 if __name__ == "__main__":
     logger.success("Finding trajectories")
     find_trajectory_nodes()
     logger.success("Constructing Dataset Folders train/test/val/")
-    constructDatasetFolders(same_nodes="same_nodes.json", choose="max")
+    constructDatasetFolders(
+        same_nodes="same_nodes.json", choose="max", num_workers=os.cpu_count()
+    )
+    logger.success("Packing train/test/val into one file per trajectory")
+    pack_dataset()
     logger.success("Extending node attributes for train/test/val")
     extend_node_attributes()
     logger.success("Done constructing <3")
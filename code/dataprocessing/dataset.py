@@ -1,17 +1,151 @@
 #!/usr/bin/env python3
+import hashlib
+import json
 import os
-import pickle
+import random
 import re
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, fields
 
+import h5py
 import torch
-from dataprocessing.utils.helper_pooling import generate_multi_layer_stride
+from dataprocessing.utils.hierarchy import build_hierarchies, multi_mesh
+from dataprocessing.utils.loading import iter_trajectory_window, trajectory_topology
+from dataprocessing.utils.normalization import STATS_KEYS, RunningStats
+from dataprocessing.utils.packing import PACKED_SUFFIX, load_packed, unpack_graph
 from loguru import logger
-from torch.nn import functional as F
+from torch.utils.data import IterableDataset, get_worker_info
 from torch_geometric.data import Data, Dataset
 
 
-class MeshDataset(Dataset):
-    def __init__(self, args, mode):
+@dataclass(frozen=True)
+class Topology:
+    """
+    The static part of the graphs of a trajectory, one object shared by every
+    timestep. The tensors are referenced, not copied, by the graphs of the
+    trajectory and must not be written to in place.
+    """
+
+    edge_index: torch.Tensor
+    edge_attr: torch.Tensor
+    cells: torch.Tensor
+    mesh_pos: torch.Tensor
+    weights: torch.Tensor
+
+    @classmethod
+    def from_graph(cls, g):
+        return cls(**{f.name: g[f.name] for f in fields(cls)})
+
+    def attach(self, g):
+        """Replaces the static attributes of g by the shared ones."""
+        for f in fields(self):
+            g[f.name] = getattr(self, f.name)
+        return g
+
+
+def _mesh(g):
+    """(edge_index, n, mesh_pos) of a graph, a mesh as build_hierarchies takes it."""
+    return g.edge_index, g.x.shape[0], g.mesh_pos
+
+
+def split_fingerprint(data_file):
+    """
+    Hash of the name, size and modification time of every file of a split folder,
+    such that caches of the split are invalidated when any file is added, removed or
+    rewritten, which the modification time of the folder alone does not show.
+    """
+    h = hashlib.sha256()
+    for entry in sorted(os.scandir(data_file), key=lambda e: e.name):
+        stat = entry.stat()
+        h.update(f"{entry.name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return h.hexdigest()
+
+
+def _trajectory_stats(data_file, packed, entries):
+    """RunningStats of x, edge_attr and y of the given index entries of one trajectory."""
+    stats = {k: RunningStats() for k in STATS_KEYS}
+    if packed:
+        container = load_packed(os.path.join(data_file, entries[0][2]), mmap=True)
+        offsets = [offset for _, _, _, offset in entries]
+        stats["x"].update(container["x"][offsets])
+        stats["y"].update(container["y"][offsets])
+        # Static, counted once per timestep
+        stats["edge_attr"].update(container["edge_attr"], weight=len(offsets))
+        return stats
+    for _, _, file, _ in entries:
+        g = torch.load(os.path.join(data_file, file))
+        for k in STATS_KEYS:
+            stats[k].update(g[k])
+    return stats
+
+
+class HierarchyMixin:
+    """
+    The multi mesh hierarchies, graph placeholders and latent sizes of the
+    trajectories of a dataset, set up from the first timestep of every trajectory.
+    The dataset provides args, layer_num, mm_dir, first_graphs, max_latent_nodes
+    and max_latent_edges, and the topologies, hierarchies and graph_placeholders
+    dicts.
+    """
+
+    def _get_bi_stride(self, graphs=None, hierarchies=None):
+        """
+        Sets the topology, hierarchy and placeholder of every trajectory. Given the
+        first_graphs and their hierarchies, as load_mesh_datasets builds them for
+        all splits at once, nothing is loaded or hashed again.
+        """
+        if graphs is None:
+            graphs = self.first_graphs()
+            hierarchies = build_hierarchies(
+                self.mm_dir,
+                [_mesh(g) for g in graphs.values()],
+                self.layer_num,
+                self.args.num_workers,
+            )
+        for (t, g), hierarchy in zip(graphs.items(), hierarchies):
+            self.topologies[t] = Topology.from_graph(g)
+            self._set_hierarchy(t, hierarchy)
+            self.make_placeholder(g, hierarchy, t)
+        logger.info("Loaded multi mesh for all trajectories")
+
+    def _get_pool(self):
+        return self.hierarchies
+
+    def make_placeholder(self, g, hierarchy, trajectory):
+        # Data(x=[1768, 54], edge_index=[2, 10132], edge_attr=[10132, 3], y=[1768, 2], p=[1768, 1], cells=[3298, 3], weights=[1768, 1], mesh_pos=[1768, 2], t=598, trajectory='147')
+        x = torch.zeros((hierarchy.num_nodes[-1], self.args.latent_dim))
+        edge_index = hierarchy.m_gs[-1]
+        edge_attr = g.edge_attr
+        y = g.y
+        p = g.p
+        cells = g.cells
+        weights = torch.ones((hierarchy.num_nodes[-1], 1))
+        mesh_pos = hierarchy.mesh_pos[-1]
+        trajectory = trajectory
+        self.graph_placeholders[trajectory] = Data(
+            x=x,
+            edge_index=edge_index,
+            edge_attr=edge_attr,
+            y=y,
+            p=p,
+            cells=cells,
+            weights=weights,
+            mesh_pos=mesh_pos,
+            t=0,
+            trajectory=trajectory,
+        )
+
+    def _set_hierarchy(self, traj, hierarchy):
+        # Computed once per mesh and shared with every trajectory and split on it
+        if hierarchy.num_nodes[-1] > self.max_latent_nodes:
+            self.max_latent_nodes = hierarchy.num_nodes[-1]
+        if hierarchy.m_gs[-1].shape[-1] > self.max_latent_edges:
+            self.max_latent_edges = hierarchy.m_gs[-1].shape[-1]
+        self.hierarchies[str(traj)] = hierarchy
+
+
+class MeshDataset(HierarchyMixin, Dataset):
+    def __init__(self, args, mode, build_multi_mesh=True):
         self.args = args
         self.data_dir = args.data_dir
         self.layer_num = args.ae_layers
@@ -31,47 +165,165 @@ class MeshDataset(Dataset):
 
         self.max_latent_nodes = 0
         self.max_latent_edges = 0
-        self.trajectories = set(
-            map(lambda str: re.search("\d+", str).group(), self.processed_file_names)
-        )
-        self.m_ids = [{} for _ in range(self.layer_num)]
-        self.m_gs = [{} for _ in range(self.layer_num + 1)]
-        self.e_s = [{} for _ in range(self.layer_num)]
-        self.m_pos = [{} for _ in range(self.layer_num + 1)]
+        # Index of the split, built once: idx -> (trajectory, t, file, offset)
+        self.packed_trajs = {}
+        self._build_index()
+        # One Topology per trajectory, only x, y and p are materialized per sample
+        self.topologies = {}
+        # One MeshHierarchy per trajectory, shared by the trajectories of a mesh
+        self.hierarchies = {}
         self.graph_placeholders = {t: None for t in self.trajectories}
-        self._get_bi_stride()
+        # load_mesh_datasets builds the multi meshes of several splits together
+        if build_multi_mesh:
+            self._get_bi_stride()
         super().__init__(self.data_dir)
 
-    def _get_bi_stride(self):
-        for t in self.trajectories:
-            f = next(filter(lambda str: str.startswith(t), self.processed_file_names))
-            g = torch.load(os.path.join(self.data_file, f))
-            m_ids, m_gs, e_s = self._cal_multi_mesh(t, g)
-            self.make_placeholder(g, m_ids, m_gs, t)
-        logger.info("Loaded multi mesh for all trajectories")
+    def first_graphs(self):
+        """The first timestep of every trajectory, in sorted order of trajectory."""
+        return {t: self._load(self.first_idx[t]) for t in sorted(self.trajectories)}
+
+    def _build_index(self):
+        """
+        Lists the split folder once and maps every global idx to
+        (trajectory, t, file, offset), offset being the position of the timestep
+        within a packed trajectory. The index is reused from the manifest
+        {mode}_manifest.json as long as the files of the split are unchanged, see
+        split_fingerprint.
+        """
+        manifest = os.path.join(self.data_dir, f"{self.mode}_manifest.json")
+        self.fingerprint = split_fingerprint(self.data_file)
+        index = None
+        if os.path.isfile(manifest):
+            with open(manifest, "r") as f:
+                m = json.load(f)
+            if m.get("fingerprint") == self.fingerprint:
+                self.packed, index = m["packed"], [tuple(e) for e in m["index"]]
+        if index is None:
+            self.packed, index = self._list_split()
+            if self.args.dataset_manifest:
+                with open(manifest, "w") as f:
+                    json.dump(
+                        {
+                            "fingerprint": self.fingerprint,
+                            "packed": self.packed,
+                            "index": index,
+                        },
+                        f,
+                    )
+        self.index = index
+        self.idx_of = {(traj, t): idx for idx, (traj, t, _, _) in enumerate(index)}
+        self.trajectories = set(traj for traj, _, _, _ in index)
+        self.first_idx = {}
+        for idx, (traj, _, _, _) in enumerate(index):
+            self.first_idx.setdefault(traj, idx)
+        # Indices sorted by time, ties broken by trajectory
+        self.time_order = sorted(
+            range(len(index)), key=lambda i: (index[i][1], index[i][0])
+        )
 
-    def len(self):
-        return len(self.processed_file_names)
+    def _list_split(self):
+        files = os.listdir(self.data_file)
+        # Packed trajectories, {traj}_packed.pt, take precedence over per timestep files
+        packed_files = sorted(f for f in files if f.endswith(PACKED_SUFFIX))
+        if packed_files:
+            index = []
+            for f in packed_files:
+                traj = re.search(r"\d+", f).group()
+                ts = self._get_packed(traj)["t"].tolist()
+                index.extend((traj, t, f, i) for i, t in enumerate(ts))
+            return True, index
+        # {traj}_data_{i}.pt, i is global within the split and the timesteps of
+        # a trajectory are saved in order, so t is i minus the trajectory's first i
+        entries = []
+        for f in files:
+            match = re.search(r"(\d+)_data_(\d+)\.pt$", f)
+            if match is not None:
+                entries.append((int(match.group(2)), match.group(1), f))
+        entries.sort()
+        first = {}
+        for i, traj, _ in entries:
+            first.setdefault(traj, i)
+        return False, [(traj, i - first[traj], f, 0) for i, traj, f in entries]
+
+    def _load(self, idx):
+        traj, _, file, offset = self.index[idx]
+        if self.packed:
+            return unpack_graph(self._get_packed(traj), offset)
+        return torch.load(os.path.join(self.data_file, file))
+
+    def _get_packed(self, traj):
+        # Memory mapped once per process, get returns views into the mapping
+        if traj not in self.packed_trajs:
+            self.packed_trajs[traj] = load_packed(
+                os.path.join(self.data_file, f"{traj}{PACKED_SUFFIX}"), mmap=True
+            )
+        return self.packed_trajs[traj]
 
-    def _get_pool(self):
-        return self.m_ids, self.m_gs, self.e_s, self.m_pos
+    def __getstate__(self):
+        # Pickling the mapped tensors would copy them into every spawned worker,
+        # drop them and let each worker map the files itself
+        state = self.__dict__.copy()
+        state["packed_trajs"] = {}
+        return state
+
+    def len(self):
+        return len(self.index)
 
     @property
     def processed_file_names(self):
-        return os.listdir(self.data_file)
+        return sorted(set(file for _, _, file, _ in self.index))
 
     def get(self, idx):
-        file = list(
-            filter(
-                lambda str: str.endswith(f"data_{idx}.pt"), self.processed_file_names
-            )
-        )[0]
-        g = torch.load(os.path.join(self.data_file, file))
-        g.x = F.normalize(g.x)
+        # Not normalized, that is done per batch by the loader's Normalizer
+        g = self._load(idx)
+        self.topologies[g.trajectory].attach(g)
         return g  # (G, m_ids, m_gs, e_s) -> max m_ids
 
-    def _get_pool(self):
-        return self.m_ids, self.m_gs, self.e_s, self.m_pos
+    def get_by_time(self, trajectory, t):
+        return self.get(self.idx_of[(trajectory, t)])
+
+    def stats(self, num_workers=1):
+        """
+        Mean and variance of x, edge_attr and y over the whole split, one
+        RunningStats per key. Trajectories are summarized in parallel and merged
+        in sorted order, the result is saved as {mode}_stats.pt next to the
+        split and reused as long as the files of the split are unchanged, see
+        split_fingerprint.
+        """
+        stats_file = os.path.join(self.data_dir, f"{self.mode}_stats.pt")
+        num_features = self._load(0).x.shape[-1]
+        if os.path.isfile(stats_file):
+            saved = torch.load(stats_file)
+            if (
+                saved.get("fingerprint") == self.fingerprint
+                and saved["num_features"] == num_features
+            ):
+                return {
+                    k: RunningStats.from_state_dict(v)
+                    for k, v in saved["stats"].items()
+                }
+        trajectories = sorted(self.trajectories)
+        entries = [[e for e in self.index if e[0] == traj] for traj in trajectories]
+        tasks = [(self.data_file, self.packed, e) for e in entries]
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                traj_stats = list(executor.map(_trajectory_stats, *zip(*tasks)))
+        else:
+            traj_stats = [_trajectory_stats(*task) for task in tasks]
+        stats = {k: RunningStats() for k in STATS_KEYS}
+        for s in traj_stats:
+            for k in STATS_KEYS:
+                stats[k].merge(s[k])
+        torch.save(
+            {
+                "fingerprint": self.fingerprint,
+                "num_features": num_features,
+                "stats": {k: v.state_dict() for k, v in stats.items()},
+            },
+            stats_file,
+        )
+        logger.info(f"Saved normalization stats of {self.mode} to {stats_file}")
+        return stats
 
     def __next__(self):
         if self.last_idx == self.len() - 1:
@@ -83,64 +335,179 @@ class MeshDataset(Dataset):
     def __iter__(self):
         return self
 
-    def make_placeholder(self, g, m_ids, m_gs, trajectory):
-        # Data(x=[1768, 54], edge_index=[2, 10132], edge_attr=[10132, 3], y=[1768, 2], p=[1768, 1], cells=[3298, 3], weights=[1768, 1], mesh_pos=[1768, 2], t=598, trajectory='147')
-        x = torch.zeros((len(m_ids[-1]), self.args.latent_dim))
-        edge_index = m_gs[-1]
-        edge_attr = g.edge_attr
-        y = g.y
-        p = g.p
-        cells = g.cells
-        weights = torch.ones((len(m_ids[-1]), 1))
-        mesh_pos = g.mesh_pos
-        for m_id in m_ids:
-            mesh_pos = mesh_pos[m_id]
-        trajectory = trajectory
-        self.graph_placeholders[trajectory] = Data(
-            x=x,
-            edge_index=edge_index,
-            edge_attr=edge_attr,
-            y=y,
-            p=p,
-            cells=cells,
-            weights=weights,
-            mesh_pos=mesh_pos,
-            t=0,
-            trajectory=trajectory,
-        )
 
-    def _cal_multi_mesh(self, traj, g):
-        mmfile = os.path.join(
-            self.mm_dir, str(traj) + "_mmesh_layer_" + str(self.layer_num) + ".dat"
-        )
-        mmexist = os.path.isfile(mmfile)
-        if not mmexist:
-            logger.info(f"Calculating multi mesh for trajectory {traj}")
-            edge_i = g.edge_index
-            n = g.x.shape[0]
-            m_gs, m_ids, e_s = generate_multi_layer_stride(
-                edge_i, self.layer_num, n=n, pos_mesh=None
+def load_mesh_datasets(args, modes=("train", "test", "val"), stream=False):
+    """
+    Creates the MeshDataset of every mode. The multi meshes of the trajectories of
+    all modes are built together on args.num_workers processes first, so cold starts
+    are not limited to one core and one split at a time.
+    With stream, H5StreamDataset streams every mode from the h5 files in
+    args.h5_dir instead, the train split shuffled if args.shuffle.
+
+    Returns:
+      list: The datasets, in the order of modes.
+    """
+    if stream:
+        datasets = [
+            H5StreamDataset(
+                args,
+                mode,
+                shuffle=args.shuffle and mode == "train",
+                build_multi_mesh=False,
             )
-            m_mesh = {"m_gs": m_gs, "m_ids": m_ids, "e_s": e_s}
-            pickle.dump(m_mesh, open(mmfile, "wb"))
-        else:
-            m_mesh = pickle.load(open(mmfile, "rb"))
-            m_gs, m_ids, e_s = m_mesh["m_gs"], m_mesh["m_ids"], m_mesh["e_s"]
-        if len(m_ids[-1]) > self.max_latent_nodes:
-            self.max_latent_nodes = len(m_ids[-1])
-        if m_gs[-1].shape[-1] > self.max_latent_edges:
-            self.max_latent_edges = m_gs[-1].shape[-1]
-        mesh_pos = g.mesh_pos
-        self.m_pos[0][str(traj)] = mesh_pos
-        for i in range(len(m_ids)):
-            mesh_pos = mesh_pos[m_ids[i]]
-            self.m_pos[i + 1][str(traj)] = mesh_pos
-            self.m_ids[i][str(traj)] = torch.tensor(m_ids[i])
-        for j in range(len(m_gs)):
-            self.m_gs[j][str(traj)] = m_gs[j]
-        for k in range(len(e_s)):
-            self.e_s[k][str(traj)] = torch.tensor(e_s[k])
-        return m_ids, m_gs, e_s
+            for mode in modes
+        ]
+    else:
+        datasets = [MeshDataset(args, mode, build_multi_mesh=False) for mode in modes]
+    graphs = [dataset.first_graphs() for dataset in datasets]
+    hierarchies = build_hierarchies(
+        datasets[0].mm_dir,
+        [_mesh(g) for split in graphs for g in split.values()],
+        args.ae_layers,
+        args.num_workers,
+    )
+    start = 0
+    for dataset, split in zip(datasets, graphs):
+        dataset._get_bi_stride(split, hierarchies[start : start + len(split)])
+        start += len(split)
+    return datasets
+
+
+class H5StreamDataset(HierarchyMixin, IterableDataset):
+    """
+    Streams graphs straight from the raw {train, valid, test}.h5 files, with the
+    same features as load_trajectories, without converting the dataset first.
+    Every trajectory is read in windows of chunk_size timesteps, and the windows
+    are sharded across the DataLoader workers.
+    Args:
+        args: Uses args.h5_dir, the folder holding the h5 files.
+        mode (str): 'train', 'test' or 'val'.
+        trajectories (list, optional): The trajectories to stream, defaults to all.
+        chunk_size (int): Number of timesteps read at once. Defaults to 50.
+        shuffle (bool): Shuffle the order of the windows and, through a buffer of
+            shuffle_buffer graphs, the order of the graphs. Defaults to False.
+        shuffle_buffer (int): Size of the shuffle buffer. Defaults to 1000.
+        seed (int): Seed of the shuffling, combined with the epoch. Defaults to 0.
+        number_ts (int): The maximum number of timesteps per trajectory. Defaults to 600.
+        build_multi_mesh (bool): Build the hierarchies and placeholders of the
+            trajectories from their h5 topology. Defaults to True.
+    The trajectories of the h5 files are keyed from 0 in every file, so the graphs
+    are named {mode}_{key} to keep the hierarchies of the splits apart.
+    """
+
+    def __init__(
+        self,
+        args,
+        mode,
+        trajectories=None,
+        chunk_size=50,
+        shuffle=False,
+        shuffle_buffer=1000,
+        seed=0,
+        number_ts=600,
+        build_multi_mesh=True,
+    ):
+        super().__init__()
+        if mode not in ["train", "test", "val"]:
+            mode = "train"
+        self.args = args
+        self.mode = mode
+        self.layer_num = args.ae_layers
+        filename = "valid" if mode == "val" else mode
+        self.datafile = os.path.join(args.h5_dir, f"{filename}.h5")
+        self.mm_dir = os.path.join(args.h5_dir, "mm_files/")
+        if not os.path.exists(self.mm_dir):
+            os.mkdir(self.mm_dir)
+        self.chunk_size = chunk_size
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        # (trajectory, start, stop) of every window, the unit of work of a worker
+        self.windows = []
+        with h5py.File(self.datafile, "r") as data:
+            if trajectories is None:
+                trajectories = list(data.keys())
+            for t in trajectories:
+                num_ts = min(len(data[t]["velocity"]) - 1, number_ts)
+                for start in range(0, num_ts, chunk_size):
+                    self.windows.append((t, start, min(start + chunk_size, num_ts)))
+        self.trajectories = trajectories
+        self.max_latent_nodes = 0
+        self.max_latent_edges = 0
+        self.topologies = {}
+        self.hierarchies = {}
+        self.graph_placeholders = {self._name(t): None for t in trajectories}
+        # load_h5_datasets builds the multi meshes of several splits together
+        if build_multi_mesh:
+            self._get_bi_stride()
+
+    def _name(self, t):
+        return f"{self.mode}_{t}"
+
+    def first_graphs(self):
+        """The first timestep of every trajectory, in sorted order of trajectory."""
+        with h5py.File(self.datafile, "r") as data:
+            return {
+                self._name(t): self._first_graph(data, t)
+                for t in sorted(self.trajectories)
+            }
+
+    def first_graph(self):
+        """The first graph of the split, e.g. for the input dimensions of the model."""
+        with h5py.File(self.datafile, "r") as data:
+            return self._first_graph(data, min(self.trajectories))
+
+    def _first_graph(self, data, t):
+        node_type, edge_index = trajectory_topology(data[t])
+        return next(
+            iter_trajectory_window(data[t], self._name(t), node_type, edge_index, 0, 1)
+        )
+
+    def __len__(self):
+        return sum(stop - start for _, start, stop in self.windows)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _worker_windows(self):
+        windows = list(self.windows)
+        if self.shuffle:
+            # Same permutation in every worker, so the shards stay disjoint
+            random.Random(self.seed + self.epoch).shuffle(windows)
+        worker = get_worker_info()
+        if worker is None:
+            return windows, 0
+        return windows[worker.id :: worker.num_workers], worker.id
+
+    def _iter_graphs(self, windows):
+        topologies = {}
+        with h5py.File(self.datafile, "r") as data:
+            for t, start, stop in windows:
+                if t not in topologies:
+                    topologies[t] = trajectory_topology(data[t])
+                node_type, edge_index = topologies[t]
+                yield from iter_trajectory_window(
+                    data[t], self._name(t), node_type, edge_index, start, stop
+                )
+
+    def __iter__(self):
+        windows, worker_id = self._worker_windows()
+        graphs = self._iter_graphs(windows)
+        if not self.shuffle:
+            yield from graphs
+            return
+        rng = random.Random(self.seed + self.epoch * 1000 + worker_id)
+        buffer = []
+        for g in graphs:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(g)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = g
+        rng.shuffle(buffer)
+        yield from buffer
 
 
 class DatasetPairs(Dataset):
@@ -190,25 +557,9 @@ class DatasetPairs(Dataset):
         return self
 
     def _cal_multi_mesh(self, traj, g):
-        mmfile = os.path.join(
-            self.mm_dir, str(traj) + "_mmesh_layer_" + str(self.layer_num) + ".dat"
+        self.hierarchy = multi_mesh(
+            self.mm_dir, g.edge_index, g.x.shape[0], self.layer_num, g.mesh_pos
         )
-        mmexist = os.path.isfile(mmfile)
-        if not mmexist:
-            edge_i = g.edge_index
-            n = g.x.shape[0][0]
-            m_gs, m_ids, e_s = generate_multi_layer_stride(
-                edge_i, self.layer_num, n=n, pos_mesh=None
-            )
-            m_mesh = {"m_gs": m_gs, "m_ids": m_ids, "e_s": e_s}
-            pickle.dump(m_mesh, open(mmfile, "wb"))
-        else:
-            m_mesh = pickle.load(open(mmfile, "rb"))
-            m_gs, m_ids, e_s = m_mesh["m_gs"], m_mesh["m_ids"], m_mesh["e_s"]
-
-        self.m_ids = m_ids
-        self.m_gs = m_gs
-        self.e_s = e_s
 
 
 class LatentVectorPairDataset(Dataset):
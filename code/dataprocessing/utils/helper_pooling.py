@@ -3,52 +3,77 @@ import scipy
 import torch
 
 _INF = _INF = 1 + 1e10
-
-
-def _BFS_dist(adj_list, n_nodes, seed, mask=None):
-    # mask: meaning only search within the subset indicated by it, any outside nodes are not reachable
-    #       can be achieved by marking outside nodes as visited, dist to inf
-    res = np.ones(n_nodes) * _INF
-    vistied = [False for _ in range(n_nodes)]
-    if isinstance(seed, list):
-        for s in seed:
-            res[s] = 0
-            vistied[s] = True
-        frontier = seed
-    else:
-        res[seed] = 0
-        vistied[seed] = True
-        frontier = [seed]
-
-    depth = 0
-    track = [frontier]
-    while frontier:
-        this_level = frontier
-        depth += 1
-        frontier = []
-        while this_level:
-            f = this_level.pop(0)
-            for n in adj_list[f]:
-                if not vistied[n]:
-                    vistied[n] = True
-                    frontier.append(n)
-                    res[n] = depth
-        # record each level
-        track.append(frontier)
-
-    return res, track
-
-
-def _BFS_dist_all(adj_list, n_nodes):
-    res = np.zeros((n_nodes, n_nodes))
-    for i in range(n_nodes):
-        res[i], _ = _BFS_dist(adj_list, n_nodes, i)
-    return res
+# Clusters up to this size get their seed from the exact minimum average depth,
+# covers every cylinder_flow mesh so their hierarchies are unchanged
+SEED_EXACT_MAX_NODES = 5000
+# BFS sweeps used to estimate the average depth of larger clusters
+SEED_LANDMARKS = 16
+# Bound on the rows of depth matrices computed at once, in number of entries
+_DEPTH_BLOCK = 2**23
+
+
+def _BFS_dist(adj, seed):
+    """
+    Multi-source BFS over a CSR adjacency, one level per step with the whole
+    frontier expanded at once.
+
+    Args:
+      adj (scipy.sparse.csr_array): The [n_nodes, n_nodes] adjacency.
+      seed (int or list): The source node(s).
+
+    Returns:
+      (np.ndarray, np.ndarray): The depth of each node, _INF if unreachable, and the
+      index of the source that reached it, -1 if unreachable.
+    """
+    indptr, indices = adj.indptr, adj.indices
+    frontier = np.atleast_1d(np.asarray(seed, dtype=np.int64))
+    depth = np.full(adj.shape[0], _INF)
+    label = np.full(adj.shape[0], -1, dtype=np.int64)
+    depth[frontier] = 0
+    label[frontier] = np.arange(len(frontier))
+    level = 0
+    while frontier.size:
+        level += 1
+        starts, counts = indptr[frontier], np.diff(indptr)[frontier]
+        # positions of all neighbours of the frontier in indices
+        offsets = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        neighbours = indices[np.repeat(starts, counts) + offsets]
+        sources = np.repeat(label[frontier], counts)
+        new = depth[neighbours] == _INF
+        frontier, first = np.unique(neighbours[new], return_index=True)
+        depth[frontier] = level
+        label[frontier] = sources[new][first]
+
+    return depth, label
+
+
+def _depth_sums(adj, sources, c, axis=1):
+    """
+    Sums the BFS depths from the sources to the nodes of c, per source (axis=1) or
+    per node of c (axis=0). Computed in blocks of sources so only a few rows of the
+    depth matrix exist at a time.
+    """
+    sums = []
+    block = max(_DEPTH_BLOCK // adj.shape[0], 1)
+    for i in range(0, len(sources), block):
+        depth = scipy.sparse.csgraph.shortest_path(
+            adj, method="D", unweighted=True, indices=sources[i : i + block]
+        )
+        sums.append(depth[:, c].sum(axis=axis))
+    return np.concatenate(sums) if axis == 1 else np.sum(sums, axis=0)
 
 
 def _adj_mat_to_flat_edge(adj_mat):
+    # flat edges of the nonzero entries in row major order, for dense or sparse
     if isinstance(adj_mat, np.ndarray):
         s, r = np.where(adj_mat.astype(bool))
+    elif scipy.sparse.issparse(adj_mat):
+        adj_mat = scipy.sparse.csr_array(adj_mat)
+        # merge duplicates and sort the columns of each row, as np.where orders them
+        adj_mat.sum_duplicates()
+        s, r = adj_mat.nonzero()
     else:
         print(f"tobe implemented _adj_mat_to_flat_edge, type : {type(adj_mat)}")
         exit(1)
@@ -56,8 +81,7 @@ def _adj_mat_to_flat_edge(adj_mat):
 
 
 def pool_edge(g, idx, num_nodes):
-    # g in scipy sparse mat
-    g = g.toarray()
+    # g in scipy sparse mat, stays sparse, only its nonzero entries are listed
     g = _adj_mat_to_flat_edge(g)  # now flat edge list
     # idx is list
     idx = np.array(idx, dtype=np.longlong)
@@ -74,19 +98,42 @@ def pool_edge(g, idx, num_nodes):
     return new_g, e_idx
 
 
-def _min_ave_seed(adj_list, clusters):
+def _min_ave_seed(adj, clusters, pos_mesh=None, max_exact=SEED_EXACT_MAX_NODES):
+    """
+    Picks one seed per cluster, the node with the minimum average BFS depth to the
+    rest of its cluster. Clusters of up to max_exact nodes are solved exactly, one
+    BFS per node in blocks of _DEPTH_BLOCK entries, never the full depth matrix.
+    Larger clusters use a heuristic: the node closest to the cluster centroid when
+    pos_mesh is given, else the node with the minimum average depth to a few
+    landmarks of the cluster.
+    """
     seeds = []
-    dist = _BFS_dist_all(adj_list, len(adj_list))
     for c in clusters:
-        d_c = dist[c]
-        d_c = d_c[:, c]
-        d_sum = np.sum(d_c, axis=1)
-        min_ave_depth_node = c[np.argmin(d_sum)]
-        seeds.append(min_ave_depth_node)
+        if len(c) <= max_exact:
+            seeds.append(c[np.argmin(_depth_sums(adj, c, c))])
+        elif pos_mesh is not None:
+            seeds.append(_centroid_seed(pos_mesh, c))
+        else:
+            seeds.append(_landmark_seed(adj, c))
 
     return seeds
 
 
+def _centroid_seed(pos_mesh, c):
+    # the node closest to the cluster centroid
+    pos = np.asarray(pos_mesh)[c]
+    centroid = pos.mean(axis=0)
+    return c[np.argmin(np.sum((pos - centroid) ** 2, axis=1))]
+
+
+def _landmark_seed(adj, c, n_landmarks=SEED_LANDMARKS):
+    # The average depth of a node to the cluster is estimated by its average depth
+    # to landmarks spread evenly over the cluster, one BFS sweep per landmark.
+    landmarks = np.unique(np.linspace(0, len(c) - 1, n_landmarks).astype(int))
+    d_sum = _depth_sums(adj, np.asarray(c)[landmarks], c, axis=0)
+    return c[np.argmin(d_sum)]
+
+
 def triangles_to_edges(cells):
     """Computes mesh edges from triangles."""
     # collect edges from triangles
@@ -112,44 +159,24 @@ def triangles_to_edges(cells):
     return torch.stack((torch.cat((s, r), 0), torch.cat((r, s), 0))).numpy()
 
 
-def _find_clusters(adj_list, mask=None):
-    n_nodes = len(adj_list)
-    if isinstance(mask, list):
-        remaining_nodes = []
-        for i, m in enumerate(mask):
-            if m is True:
-                remaining_nodes.append(i)
-    else:
-        remaining_nodes = list(range(n_nodes))
-    cluster = []
-    while remaining_nodes:
-        if len(remaining_nodes) > 1:
-            seed = remaining_nodes[0]
-            dist, _ = _BFS_dist(adj_list, n_nodes, seed, mask)
-            tmp = []
-            new_remaining = []
-            for n in remaining_nodes:
-                if dist[n] != _INF:
-                    tmp.append(n)
-                else:
-                    new_remaining.append(n)
-            cluster.append(tmp)
-            remaining_nodes = new_remaining
-        else:
-            cluster.append([remaining_nodes[0]])
-            break
-
-    return cluster
+def _find_clusters(adj):
+    """
+    Splits the graph into its connected components, ordered by their lowest node
+    and each sorted ascending.
+    """
+    _, labels = scipy.sparse.csgraph.connected_components(adj, directed=False)
+    # number the components by their lowest node
+    _, first = np.unique(labels, return_index=True)
+    relabel = np.empty_like(first)
+    relabel[labels[np.sort(first)]] = np.arange(len(first))
+    labels = relabel[labels]
+    order = np.argsort(labels, kind="stable")
+    return np.split(order, np.cumsum(np.bincount(labels))[:-1])
 
 
 def bstride_selection(flat_edge, n_nodes, pos_mesh=None):
     combined_idx_kept = set()
-
-    #####_flat_edge_to_adj_list:
-    # adj_list holds all connection between nodes.
-    adj_list = [[] for _ in range(n_nodes)]
-    for i in range(len(flat_edge[0])):
-        adj_list[flat_edge[0, i]].append(flat_edge[1, i])
+    flat_edge = np.asarray(flat_edge)
 
     #####_flat_edge_to_adj_mat:
     adj_mat = scipy.sparse.coo_array(
@@ -160,25 +187,25 @@ def bstride_selection(flat_edge, n_nodes, pos_mesh=None):
 
     # adj mat enhance the diag
     adj_mat.setdiag(1)
+    adj_mat = adj_mat.tocsr()
     # 0. compute clusters, each of which should be deivded independantly
 
     #####_find_clusters:
-    clusters = _find_clusters(adj_list)
+    clusters = _find_clusters(adj_mat)
     #####_find_clusters:
 
-    # 1. seeding: by BFS_all for small graphs, or by seed_heuristic for larger graphs
-    seeds = _min_ave_seed(adj_list, clusters)
-    for seed, c in zip(seeds, clusters):
-        odd = set()
-        even = set()
-        index_kept = set()
-        dist_from_cental_node, _ = _BFS_dist(adj_list, len(adj_list), seed)
-        # Walks through the graph distinguishing nodes between odd and even length from seed node.
-        for i in range(len(dist_from_cental_node)):
-            if dist_from_cental_node[i] % 2 == 0 and dist_from_cental_node[i] != _INF:
-                even.add(i)
-            elif dist_from_cental_node[i] % 2 == 1 and dist_from_cental_node[i] != _INF:
-                odd.add(i)
+    # 1. seeding: exact for small graphs, or by seed_heuristic for larger graphs
+    seeds = _min_ave_seed(adj_mat, clusters, pos_mesh)
+    # the clusters are disjoint, a single BFS from all seeds gives each node its depth
+    # from the seed of its own cluster
+    depth, _ = _BFS_dist(adj_mat, seeds)
+    for c in clusters:
+        # Distinguishes nodes between odd and even depth from the seed node. The sets
+        # are filled in the same order as by a per node loop, the order of
+        # combined_idx_kept, and hence of m_ids, is the iteration order of the sets.
+        dist_from_cental_node = depth[c]
+        even = set(c[dist_from_cental_node % 2 == 0].tolist())
+        odd = set(c[dist_from_cental_node % 2 == 1].tolist())
         # 4. enforce n//2 candidates
         if len(even) <= len(odd) or len(odd) == 0:
             index_kept = even
@@ -194,18 +221,16 @@ def bstride_selection(flat_edge, n_nodes, pos_mesh=None):
             # cal stride based on delta nodes to select
             # generate strided idx from rmvd idx
             # union
-            index_rmvd = list(index_rmvd)
-            dist_id_rmvd = np.array(dist_from_cental_node)[index_rmvd]
-            sort_index = np.argsort(dist_id_rmvd)
+            index_rmvd = np.array(list(index_rmvd), dtype=np.int64)
+            sort_index = np.argsort(depth[index_rmvd])
             stride = len(index_rmvd) // delta + 1
-            delta_idx = sort_index[0::stride]
-            delta_idx = set([index_rmvd[i] for i in delta_idx])
+            delta_idx = set(index_rmvd[sort_index[0::stride]].tolist())
             index_kept = index_kept.union(delta_idx)
 
         combined_idx_kept = combined_idx_kept.union(index_kept)
     # TODO: UNDERSTAND THIS SHIT!
     combined_idx_kept = list(combined_idx_kept)
-    adj_mat = adj_mat.tocsr().astype(float)
+    adj_mat = adj_mat.astype(float)
     adj_mat = adj_mat @ adj_mat
     adj_mat.setdiag(0)
     adj_mat, e_idx = pool_edge(adj_mat, combined_idx_kept, n_nodes)
@@ -222,7 +247,8 @@ def generate_multi_layer_stride(flat_edge, num_l, n, pos_mesh=None):
     for layer in range(num_l):
         n_l = n if layer == 0 else len(index_to_keep)
         index_to_keep, g, e_idx = bstride_selection(g, n_nodes=n_l, pos_mesh=pos_mesh)
-        # pos_mesh = pos_mesh[index_to_keep]
+        if pos_mesh is not None:
+            pos_mesh = pos_mesh[index_to_keep]
         m_gs.append(torch.tensor(g))
         e_s.append(e_idx)
         m_ids.append(index_to_keep)
@@ -0,0 +1,475 @@
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import pairwise
+
+import numpy as np
+import scipy
+import torch
+from loguru import logger
+from torch_geometric.data import Data
+
+from .helper_pooling import generate_multi_layer_stride
+
+# Bumped whenever generate_multi_layer_stride can return a different hierarchy for
+# the same mesh or the bundle layout changes, bundles of another version are rebuilt
+HIERARCHY_VERSION = 2
+BUNDLE_SUFFIX = ".pt"
+# Neighbours of every fine node interpolated from, as knn_interpolate does
+INTERPOLATION_K = 3
+
+# topology key -> MeshHierarchy, shared by every dataset in the process
+_hierarchies = {}
+# (topology keys of a batch, level, device) -> the collated level, least recently
+# used first, at most BATCH_CACHE_SIZE of them
+_batch_levels = OrderedDict()
+BATCH_CACHE_SIZE = 64
+
+
+class MeshHierarchy:
+    """
+    The bi-stride hierarchy of one mesh, a single object shared by every trajectory
+    on it. Level l has num_nodes[l] nodes, edges m_gs[l] and positions mesh_pos[l],
+    m_ids[l] are the nodes of level l kept in level l + 1 and e_s[l] the edges of
+    the squared adjacency of level l kept in level l + 1. Every index tensor is
+    contiguous and must not be written to in place.
+    """
+
+    __slots__ = (
+        "_devices",
+        "_interpolations",
+        "e_s",
+        "key",
+        "m_gs",
+        "m_ids",
+        "mesh_pos",
+        "num_nodes",
+    )
+
+    def __init__(self, key, m_gs, m_ids, e_s, mesh_pos=None):
+        self.key = key
+        self.m_gs = [torch.as_tensor(g, dtype=torch.long).contiguous() for g in m_gs]
+        self.m_ids = [
+            torch.as_tensor(m_id, dtype=torch.long).contiguous() for m_id in m_ids
+        ]
+        self.e_s = [
+            torch.as_tensor(e_idx, dtype=torch.long).contiguous() for e_idx in e_s
+        ]
+        self.mesh_pos = None
+        if mesh_pos is not None:
+            self.mesh_pos = [torch.as_tensor(mesh_pos)]
+            for m_id in self.m_ids:
+                self.mesh_pos.append(self.mesh_pos[-1][m_id])
+        self.num_nodes = [
+            int(self.m_gs[0].max()) + 1 if mesh_pos is None else len(mesh_pos)
+        ]
+        self.num_nodes += [len(m_id) for m_id in self.m_ids]
+        self._devices = {}
+        self._interpolations = {}
+
+    @property
+    def num_levels(self):
+        return len(self.m_ids)
+
+    def to(self, device):
+        """
+        Returns the hierarchy on device, the copy is made once and reused by every
+        later call.
+        """
+        device = torch.device(device)
+        if device == self.m_gs[0].device:
+            return self
+        if device not in self._devices:
+            h = MeshHierarchy.__new__(MeshHierarchy)
+            h.key, h.num_nodes, h._devices = self.key, self.num_nodes, {}
+            h._interpolations = {
+                level: w.to(device) for level, w in self._interpolations.items()
+            }
+            h.m_gs = [g.to(device) for g in self.m_gs]
+            h.m_ids = [m_id.to(device) for m_id in self.m_ids]
+            h.e_s = [e_idx.to(device) for e_idx in self.e_s]
+            h.mesh_pos = None
+            if self.mesh_pos is not None:
+                h.mesh_pos = [pos.to(device) for pos in self.mesh_pos]
+            self._devices[device] = h
+        return self._devices[device]
+
+    def interpolation(self, level, k=INTERPOLATION_K):
+        """
+        The interpolation from the nodes of level + 1 to the nodes of level, the
+        inverse squared distance weighted mean of the k nearest coarse nodes, as
+        knn_interpolate computes it. Built once per level from the positions.
+
+        Returns:
+          torch.Tensor: The sparse [num_nodes[level], num_nodes[level + 1]] weights.
+        """
+        if level not in self._interpolations:
+            fine = self.mesh_pos[level].cpu().numpy()
+            coarse = self.mesh_pos[level + 1].cpu().numpy()
+            k = min(k, len(coarse))
+            dist, col = scipy.spatial.cKDTree(coarse).query(fine, k=k)
+            dist, col = dist.reshape(len(fine), k), col.reshape(len(fine), k)
+            w = 1.0 / np.maximum(dist**2, 1e-16)
+            w /= w.sum(axis=1, keepdims=True)
+            row = np.repeat(np.arange(len(fine)), k)
+            # the columns of a row in ascending order, as in a coalesced tensor
+            order = np.argsort(col, axis=1, kind="stable")
+            col = np.take_along_axis(col, order, axis=1)
+            w = np.take_along_axis(w, order, axis=1)
+            self._interpolations[level] = torch.sparse_coo_tensor(
+                torch.from_numpy(np.stack([row, col.reshape(-1)])),
+                torch.from_numpy(w.reshape(-1)).to(self.mesh_pos[level].dtype),
+                (len(fine), len(coarse)),
+                is_coalesced=True,
+                check_invariants=False,
+            ).to(self.mesh_pos[level].device)
+        return self._interpolations[level]
+
+    @staticmethod
+    def node_offsets(hierarchies, level):
+        """
+        Offset of the level nodes of every graph of a batch, in batch order.
+        """
+        sizes = torch.tensor([h.num_nodes[level] for h in hierarchies])
+        return sizes.cumsum(0) - sizes
+
+    @staticmethod
+    def batch_m_ids(hierarchies, level):
+        """
+        The nodes of level kept in level + 1 of every graph of a batch, as indices
+        into the concatenated level nodes of the batch.
+        """
+        offsets = MeshHierarchy.node_offsets(hierarchies, level).tolist()
+        return torch.cat([h.m_ids[level] + o for h, o in zip(hierarchies, offsets)])
+
+    @staticmethod
+    def batch_edge_index(hierarchies, level):
+        """
+        The edges of level of every graph of a batch, offset like a collated Batch.
+        """
+        offsets = MeshHierarchy.node_offsets(hierarchies, level).tolist()
+        return torch.cat(
+            [h.m_gs[level] + o for h, o in zip(hierarchies, offsets)], dim=1
+        )
+
+    @staticmethod
+    def batch_interpolation(hierarchies, level):
+        """
+        The interpolation from level + 1 to level of every graph of a batch, as one
+        block diagonal sparse matrix.
+        """
+        rows = MeshHierarchy.node_offsets(hierarchies, level).tolist()
+        cols = MeshHierarchy.node_offsets(hierarchies, level + 1).tolist()
+        weights = [h.interpolation(level) for h in hierarchies]
+        indices = [
+            w.indices() + torch.tensor([[r], [c]], device=w.device)
+            for w, r, c in zip(weights, rows, cols)
+        ]
+        return torch.sparse_coo_tensor(
+            torch.cat(indices, dim=1),
+            torch.cat([w.values() for w in weights]),
+            (
+                sum(h.num_nodes[level] for h in hierarchies),
+                sum(h.num_nodes[level + 1] for h in hierarchies),
+            ),
+            is_coalesced=True,
+            check_invariants=False,
+        )
+
+    @staticmethod
+    def batch_level(hierarchies, level):
+        """
+        A level of every graph of a batch collated once per batch composition, the
+        meshes of the batch in order, and reused by every later batch of the same
+        meshes.
+
+        Returns:
+          dict: The per graph num_nodes and num_edges, and the batched edge_index
+          and mesh_pos of the level. Below the coarsest level also m_ids, and the
+          interpolation from level + 1 if the hierarchies have positions.
+        """
+        cache_key = (
+            tuple(h.key for h in hierarchies),
+            level,
+            hierarchies[0].m_gs[0].device,
+        )
+        if cache_key in _batch_levels:
+            _batch_levels.move_to_end(cache_key)
+            return _batch_levels[cache_key]
+        batch = {
+            "num_nodes": torch.tensor([h.num_nodes[level] for h in hierarchies]),
+            "num_edges": torch.tensor([h.m_gs[level].shape[-1] for h in hierarchies]),
+            "edge_index": MeshHierarchy.batch_edge_index(hierarchies, level),
+            "mesh_pos": None,
+        }
+        if hierarchies[0].mesh_pos is not None:
+            batch["mesh_pos"] = torch.cat([h.mesh_pos[level] for h in hierarchies])
+        if level < hierarchies[0].num_levels:
+            batch["m_ids"] = MeshHierarchy.batch_m_ids(hierarchies, level)
+            if batch["mesh_pos"] is not None:
+                batch["interpolation"] = MeshHierarchy.batch_interpolation(
+                    hierarchies, level
+                )
+        _batch_levels[cache_key] = batch
+        if len(_batch_levels) > BATCH_CACHE_SIZE:
+            _batch_levels.popitem(last=False)
+        return batch
+
+
+def topology_key(edge_index, n, num_l, mesh_pos=None):
+    """
+    Content hash identifying the hierarchy of a mesh. Trajectories on the same mesh
+    get the same key, any change to the mesh or the algorithm gives a new one.
+
+    Args:
+      edge_index (torch.Tensor): The edges [2, E] of the mesh.
+      n (int): The number of nodes.
+      num_l (int): The number of levels of the hierarchy.
+      mesh_pos (torch.Tensor): The node positions, used to seed large clusters.
+
+    Returns:
+      str: The hex digest.
+    """
+    h = hashlib.sha256(f"v{HIERARCHY_VERSION}-n{n}-l{num_l}".encode())
+    h.update(np.ascontiguousarray(np.asarray(edge_index, dtype=np.int64)).tobytes())
+    if mesh_pos is not None:
+        h.update(np.ascontiguousarray(np.asarray(mesh_pos, dtype=np.float32)).tobytes())
+    return h.hexdigest()
+
+
+def _flatten(levels):
+    # One flat tensor and the offsets of every level in it
+    sizes = [level.numel() for level in levels]
+    ptr = torch.zeros(len(levels) + 1, dtype=torch.long)
+    ptr[1:] = torch.tensor(sizes).cumsum(0)
+    return torch.cat([level.reshape(-1) for level in levels]), ptr
+
+
+def pack_hierarchy(key, n, m_gs, m_ids, e_s):
+    """
+    Packs a hierarchy into a bundle of flat int64 tensors with the offsets of every
+    level, m_gs levels stored as their two rows back to back.
+
+    Returns:
+      dict: The bundle, only tensors, ints and strings.
+    """
+    m_gs = [torch.as_tensor(np.asarray(g), dtype=torch.long) for g in m_gs]
+    m_ids = [torch.as_tensor(np.asarray(m_id), dtype=torch.long) for m_id in m_ids]
+    e_s = [torch.as_tensor(np.asarray(e_idx), dtype=torch.long) for e_idx in e_s]
+    bundle = {"version": HIERARCHY_VERSION, "key": key}
+    bundle["num_nodes"] = torch.tensor([n] + [len(m_id) for m_id in m_ids])
+    bundle["m_gs"], bundle["m_gs_ptr"] = _flatten(m_gs)
+    bundle["m_ids"], bundle["m_ids_ptr"] = _flatten(m_ids)
+    bundle["e_s"], bundle["e_s_ptr"] = _flatten(e_s)
+    return bundle
+
+
+def unpack_hierarchy(bundle):
+    """
+    Returns m_gs, m_ids and e_s of a bundle, every level a view into its tensors.
+    """
+    m_gs, ptr = bundle["m_gs"], bundle["m_gs_ptr"].tolist()
+    m_gs = [m_gs[a:b].view(2, -1) for a, b in pairwise(ptr)]
+    m_ids, ptr = bundle["m_ids"], bundle["m_ids_ptr"].tolist()
+    m_ids = [m_ids[a:b] for a, b in pairwise(ptr)]
+    e_s, ptr = bundle["e_s"], bundle["e_s_ptr"].tolist()
+    e_s = [e_s[a:b] for a, b in pairwise(ptr)]
+    return m_gs, m_ids, e_s
+
+
+def _valid_hierarchy(bundle, key, num_l):
+    # Rejects bundles of another version or mesh and inconsistent levels
+    if not isinstance(bundle, dict) or bundle.get("version") != HIERARCHY_VERSION:
+        return False
+    if bundle.get("key") != key:
+        return False
+    for name, levels in [("m_gs", num_l + 1), ("m_ids", num_l), ("e_s", num_l)]:
+        ptr = bundle[f"{name}_ptr"]
+        if len(ptr) != levels + 1 or ptr[-1] != len(bundle[name]):
+            return False
+        if (ptr.diff() < 0).any():
+            return False
+    m_gs, m_ids, e_s = unpack_hierarchy(bundle)
+    num_nodes = bundle["num_nodes"].tolist()
+    for i in range(num_l):
+        if len(m_ids[i]) != num_nodes[i + 1] or len(e_s[i]) != m_gs[i + 1].shape[-1]:
+            return False
+        if len(m_ids[i]) == 0 or m_ids[i].max() >= num_nodes[i]:
+            return False
+        if m_gs[i + 1].numel() and m_gs[i + 1].max() >= num_nodes[i + 1]:
+            return False
+    return True
+
+
+def save_bundle(file, bundle):
+    # Written to a temporary file first, an interrupted write never leaves a
+    # truncated bundle under the final name
+    tmp = f"{file}.{os.getpid()}.tmp"
+    torch.save(bundle, tmp)
+    os.replace(tmp, file)
+
+
+def load_bundle(file, mmap=True):
+    """
+    Loads a bundle saved by save_bundle, memory mapped by default. Only tensors and
+    plain types are unpickled (weights_only), so bundles are safe to share.
+    """
+    return torch.load(file, mmap=mmap, weights_only=True)
+
+
+def _read_hierarchy(mmfile, key, num_l):
+    try:
+        bundle = load_bundle(mmfile)
+        if _valid_hierarchy(bundle, key, num_l):
+            return unpack_hierarchy(bundle)
+    except (OSError, RuntimeError, pickle.UnpicklingError, KeyError) as e:
+        logger.warning(f"Could not read {mmfile}: {e}")
+    logger.warning(f"Rejected outdated or corrupt multi mesh {mmfile}, rebuilding")
+    return None
+
+
+def _build_hierarchy(mmfile, key, edge_index, n, num_l, mesh_pos):
+    # Runs in the worker processes of build_hierarchies
+    m_gs, m_ids, e_s = generate_multi_layer_stride(
+        edge_index, num_l, n=n, pos_mesh=mesh_pos
+    )
+    save_bundle(mmfile, pack_hierarchy(key, n, m_gs, m_ids, e_s))
+
+
+def hierarchy_file(mm_dir, key, num_l):
+    return os.path.join(mm_dir, f"{key}_mmesh_layer_{num_l}{BUNDLE_SUFFIX}")
+
+
+def build_hierarchies(mm_dir, meshes, num_l, num_workers=1):
+    """
+    Makes sure the hierarchies of all meshes are in memory. Cached ones are read
+    from mm_dir, the missing ones are built on a pool of num_workers processes,
+    one task per distinct topology, and written to mm_dir.
+
+    Args:
+      mm_dir (str): The folder of the cached hierarchies.
+      meshes (list): (edge_index, n, mesh_pos) of every mesh, duplicates allowed.
+      num_l (int): The number of levels.
+      num_workers (int): The number of processes. Defaults to 1.
+
+    Returns:
+      list: The MeshHierarchy of every mesh.
+    """
+    keys = []
+    missing = {}
+    positions = {}
+    for edge_index, n, mesh_pos in meshes:
+        key = topology_key(edge_index, n, num_l, mesh_pos)
+        keys.append(key)
+        if key in _hierarchies or key in missing:
+            continue
+        mmfile = hierarchy_file(mm_dir, key, num_l)
+        if os.path.isfile(mmfile):
+            hierarchy = _read_hierarchy(mmfile, key, num_l)
+            if hierarchy is not None:
+                _hierarchies[key] = MeshHierarchy(key, *hierarchy, mesh_pos)
+                continue
+        positions[key] = mesh_pos
+        missing[key] = (
+            mmfile,
+            key,
+            np.asarray(edge_index),
+            n,
+            num_l,
+            None if mesh_pos is None else np.asarray(mesh_pos),
+        )
+    if not missing:
+        return [_hierarchies[key] for key in keys]
+    logger.info(f"Calculating {len(missing)} multi meshes on {num_workers} processes")
+    if num_workers > 1 and len(missing) > 1:
+        with ProcessPoolExecutor(
+            max_workers=min(num_workers, len(missing))
+        ) as executor:
+            list(executor.map(_build_hierarchy, *zip(*missing.values())))
+    else:
+        for task in missing.values():
+            _build_hierarchy(*task)
+    # Every process maps the written bundles instead of holding its own copy
+    for key, (mmfile, *_) in missing.items():
+        hierarchy = unpack_hierarchy(load_bundle(mmfile))
+        _hierarchies[key] = MeshHierarchy(key, *hierarchy, positions[key])
+    return [_hierarchies[key] for key in keys]
+
+
+def multi_mesh(mm_dir, edge_index, n, num_l, mesh_pos=None):
+    """
+    Returns the bi-stride hierarchy of a mesh, computed once per topology. It is
+    looked up in memory, then in mm_dir under its topology key, and only built
+    if neither has it. Trajectories sharing a mesh share the returned tensors,
+    views into the memory mapped bundle, which must not be written to in place.
+
+    Args:
+      mm_dir (str): The folder of the cached hierarchies.
+      edge_index (torch.Tensor): The edges [2, E] of the mesh.
+      n (int): The number of nodes.
+      num_l (int): The number of levels.
+      mesh_pos (torch.Tensor): The node positions. Defaults to None.
+
+    Returns:
+      MeshHierarchy: The hierarchy.
+    """
+    (hierarchy,) = build_hierarchies(mm_dir, [(edge_index, n, mesh_pos)], num_l)
+    return hierarchy
+
+
+def save_graph_structure_bundle(file, hierarchies, graph_placeholders):
+    """
+    Saves the hierarchies of a run as one bundle, every distinct mesh stored once
+    and the trajectories referring to it by topology key. Positions are stored for
+    the finest level only, the others are derived when loading.
+
+    Args:
+      file (str): The file to write.
+      hierarchies (dict): The MeshHierarchy of every trajectory.
+      graph_placeholders (dict): The graph placeholder of every trajectory.
+    """
+    trajectories, bundles, mesh_pos = {}, {}, {}
+    for t, h in hierarchies.items():
+        trajectories[t] = h.key
+        if h.key not in bundles:
+            bundles[h.key] = pack_hierarchy(
+                h.key, h.num_nodes[0], h.m_gs, h.m_ids, h.e_s
+            )
+            mesh_pos[h.key] = None if h.mesh_pos is None else h.mesh_pos[0]
+    save_bundle(
+        file,
+        {
+            "version": HIERARCHY_VERSION,
+            "trajectories": trajectories,
+            "hierarchies": bundles,
+            "mesh_pos": mesh_pos,
+            "graph_placeholders": {
+                t: g.to_dict() for t, g in graph_placeholders.items()
+            },
+        },
+    )
+
+
+def load_graph_structure(file):
+    """
+    Loads a bundle saved by save_graph_structure_bundle, memory mapped.
+
+    Returns:
+      tuple: The MeshHierarchy of every trajectory, trajectories on the same mesh
+      sharing one, and the graph placeholders.
+    """
+    bundle = load_bundle(file)
+    if bundle.get("version") != HIERARCHY_VERSION:
+        raise ValueError(
+            f"{file} has hierarchy version {bundle.get('version')}, "
+            f"expected {HIERARCHY_VERSION}"
+        )
+    by_key = {
+        key: MeshHierarchy(key, *unpack_hierarchy(h), bundle["mesh_pos"][key])
+        for key, h in bundle["hierarchies"].items()
+    }
+    hierarchies = {t: by_key[key] for t, key in bundle["trajectories"].items()}
+    graph_placeholders = {t: Data(**g) for t, g in bundle["graph_placeholders"].items()}
+    return hierarchies, graph_placeholders
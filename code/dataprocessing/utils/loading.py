@@ -2,115 +2,126 @@ import json
 import os
 import random
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import Optional, Union
 
 import h5py
 import numpy as np
-import tensorflow as tf
 import torch
+from loguru import logger
 from torch_geometric.data import Data
 from torch_geometric.loader import DataLoader
-from torch_geometric.utils import to_networkx
+from torch_geometric.utils import degree
 
 from .normalization import get_stats
-from .triangle_to_edges import NodeType, triangles_to_edges
+from .packing import PACKED_SUFFIX, load_packed
+from .triangle_to_edges import NodeType, one_hot, triangles_to_edges
 
 
-def find_max_degree_of_graph(graph):
-    return max(graph.degree, key=lambda x: x[1])[1]
+def graph_degree(edge_index, num_nodes):
+    """In plus out degree of every node, the degree networkx reports for a DiGraph."""
+    return degree(edge_index[0], num_nodes, dtype=torch.long) + degree(
+        edge_index[1], num_nodes, dtype=torch.long
+    )
+
 
+def node_edge_attr_block(edge_index, edge_attr, num_nodes, max_degree):
+    """
+    Gathers, for every node, the attributes of its outgoing edges in the order they
+    appear in edge_index, flattened and zero padded to max_degree edges.
+
+    Args:
+      edge_index (torch.Tensor): [2, E] edge index.
+      edge_attr (torch.Tensor): [E, F] edge attributes.
+      num_nodes (int): Number of nodes.
+      max_degree (int): Number of edges to pad to.
 
-def get_traj_edge_attr(graph, max_degree):
-    # node_attributes = nx.get_node_attributes(graph, "x")
-    node_features = torch.zeros((graph.number_of_nodes(), max_degree * 3))
-    for idx, n in enumerate(graph.nodes):
-        edge_attr = torch.flatten(
-            torch.tensor(
-                [attr["edge_attr"] for _, _, attr in list(graph.edges(1, data=True))]
+    Returns:
+      torch.Tensor: [num_nodes, max_degree * F] node features.
+    """
+    # Stable sort by sender keeps the edge_index order within each node
+    src, perm = torch.sort(edge_index[0], stable=True)
+    ptr = torch.zeros(num_nodes + 1, dtype=torch.long)
+    ptr[1:] = torch.cumsum(torch.bincount(src, minlength=num_nodes), dim=0)
+    # Position of every edge among the outgoing edges of its sender
+    rank = torch.arange(src.shape[0]) - ptr[src]
+    block = edge_attr.new_zeros((num_nodes, max_degree, edge_attr.shape[-1]))
+    block[src, rank] = edge_attr[perm]
+    return block.view(num_nodes, -1)
+
+
+def _split_topologies(split_dir):
+    """
+    Returns {traj: (edge_index, edge_attr, num_nodes)} of a split folder, from the
+    packed trajectories if there are any, otherwise from one graph per trajectory.
+    """
+    files = os.listdir(split_dir)
+    packed_files = [f for f in files if f.endswith(PACKED_SUFFIX)]
+    topologies = {}
+    for f in packed_files or files:
+        t = re.search(r"\d+", f).group()
+        if t in topologies:
+            continue
+        if packed_files:
+            # Cloned out of the mapping, the file is rewritten by _extend_split
+            g = load_packed(os.path.join(split_dir, f), mmap=True)
+            topologies[t] = (
+                g["edge_index"].clone(),
+                g["edge_attr"].clone(),
+                g["x"].shape[1],
             )
-        )
-        node_features[idx][: len(edge_attr)] = edge_attr
-    return node_features
-
-
-def create_traj_node_attr_dict(train, test, val, max_degree):
-    train_trajs = set(map(lambda str: re.search("\d+", str).group(), os.listdir(train)))
-    val_trajs = set(map(lambda str: re.search("\d+", str).group(), os.listdir(val)))
-    test_trajs = set(map(lambda str: re.search("\d+", str).group(), os.listdir(test)))
-    new_nodes_traj = {}
-    for t in train_trajs:
-        f = next(filter(lambda str: str.startswith(t), os.listdir(train)))
-        g = torch.load(os.path.join(train, f))
-        graph = to_networkx(g, node_attrs=["x"], edge_attrs=["edge_attr"])
-        new_nodes_traj[t] = get_traj_edge_attr(graph, max_degree)
-    for t in val_trajs:
-        f = next(filter(lambda str: str.startswith(t), os.listdir(val)))
-        g = torch.load(os.path.join(val, f))
-        graph = to_networkx(g, node_attrs=["x"], edge_attrs=["edge_attr"])
-        new_nodes_traj[t] = get_traj_edge_attr(graph, max_degree)
-    for t in test_trajs:
-        f = next(filter(lambda str: str.startswith(t), os.listdir(test)))
-        g = torch.load(os.path.join(test, f))
-        graph = to_networkx(g, node_attrs=["x"], edge_attrs=["edge_attr"])
-        new_nodes_traj[t] = get_traj_edge_attr(graph, max_degree)
-    return new_nodes_traj
-
-
-def max_degree_of_dataset(train, test, val):
-    train_trajs = set(map(lambda str: re.search("\d+", str).group(), os.listdir(train)))
-    val_trajs = set(map(lambda str: re.search("\d+", str).group(), os.listdir(val)))
-    test_trajs = set(map(lambda str: re.search("\d+", str).group(), os.listdir(test)))
-    max_degree = 0
-
-    for t in train_trajs:
-        f = next(filter(lambda str: str.startswith(t), os.listdir(train)))
-        g = torch.load(os.path.join(train, f))
-        graph = to_networkx(g, node_attrs=["x"], edge_attrs=["edge_attr"])
-        max = find_max_degree_of_graph(graph)
-        if max > max_degree:
-            max_degree = max
-
-    for t in val_trajs:
-        f = next(filter(lambda str: str.startswith(t), os.listdir(val)))
-        g = torch.load(os.path.join(val, f))
-        graph = to_networkx(g, node_attrs=["x"], edge_attrs=["edge_attr"])
-        max = find_max_degree_of_graph(graph)
-        if max > max_degree:
-            max_degree = max
-    for t in test_trajs:
-        f = next(filter(lambda str: str.startswith(t), os.listdir(test)))
-        g = torch.load(os.path.join(test, f))
-        graph = to_networkx(g, node_attrs=["x"], edge_attrs=["edge_attr"])
-        max = find_max_degree_of_graph(graph)
-        if max > max_degree:
-            max_degree = max
-    return max
-
-
-def find_and_replace(file, traj, new_nodes):
-    g = torch.load(file)
-    g.x = torch.cat((g.x, new_nodes[traj]), dim=1)
-    torch.save(g, file)
+        else:
+            g = torch.load(os.path.join(split_dir, f), weights_only=False)
+            topologies[t] = (g.edge_index, g.edge_attr, g.x.shape[0])
+    return topologies
+
+
+def _extend_split(split_dir, new_nodes):
+    files = os.listdir(split_dir)
+    packed_files = [f for f in files if f.endswith(PACKED_SUFFIX)]
+    if packed_files:
+        # One read and write per trajectory, x is [T, N, F]
+        for f in packed_files:
+            t = re.search(r"\d+", f).group()
+            packed = load_packed(os.path.join(split_dir, f))
+            block = new_nodes[t].expand(packed["x"].shape[0], -1, -1)
+            packed["x"] = torch.cat((packed["x"], block), dim=-1)
+            torch.save(packed, os.path.join(split_dir, f))
+        return
+    for f in files:
+        t = re.search(r"\d+", f).group()
+        g = torch.load(os.path.join(split_dir, f), weights_only=False)
+        g.x = torch.cat((g.x, new_nodes[t]), dim=1)
+        torch.save(g, os.path.join(split_dir, f))
 
 
 def extend_node_attributes(
     data_dir="data/cylinder_flow", trajectories="trajectories_1768"
 ):
+    """
+    Appends to the node features of every graph the attributes of the node's
+    outgoing edges, padded to the maximum degree of the dataset, such that all
+    splits get the same number of node features.
+
+    Args:
+      data_dir (str, optional): The directory where the data is stored. Defaults to 'data/cylinder_flow'.
+      trajectories (str, optional): The folder holding train/val/test. Defaults to 'trajectories_1768'.
+    """
     folder = os.path.join(data_dir, trajectories)
-    train_dir = os.path.join(folder, "train")
-    val_dir = os.path.join(folder, "val")
-    test_dir = os.path.join(folder, "test")
-    max_degree = max_degree_of_dataset(train_dir, test_dir, val_dir)
-    new_node_attr = create_traj_node_attr_dict(train_dir, test_dir, val_dir, max_degree)
-    for f in os.listdir(train_dir):
-        t = re.search("\d+", f).group()
-        find_and_replace(os.path.join(train_dir, f), t, new_node_attr)
-    for f in os.listdir(val_dir):
-        t = re.search("\d+", f).group()
-        find_and_replace(os.path.join(val_dir, f), t, new_node_attr)
-    for f in os.listdir(test_dir):
-        t = re.search("\d+", f).group()
-        find_and_replace(os.path.join(test_dir, f), t, new_node_attr)
+    split_dirs = [os.path.join(folder, split) for split in ["train", "val", "test"]]
+    topologies = [_split_topologies(split_dir) for split_dir in split_dirs]
+    max_degree = max(
+        int(graph_degree(edge_index, n).max())
+        for split in topologies
+        for edge_index, _, n in split.values()
+    )
+    for split_dir, split in zip(split_dirs, topologies):
+        new_nodes = {
+            t: node_edge_attr_block(edge_index, edge_attr, n, max_degree)
+            for t, (edge_index, edge_attr, n) in split.items()
+        }
+        _extend_split(split_dir, new_nodes)
 
 
 def load_preprocessed(args):
@@ -201,6 +212,7 @@ def constructDatasetFolders(
     choose: Optional[Union[str, int, None]],
     data_dir="data/cylinder_flow/",
     mode="train",
+    num_workers=1,
 ):
     """
     Constructs dataset folders for training, validation, and testing.
@@ -210,6 +222,8 @@ def constructDatasetFolders(
       choose (str or int or None, optional): Determines the selection of trajectories. If 'min', the node with the least trajectories is chosen. If an integer, a node with that specific amount of trajectories is chosen. If None, the node with the most trajectories is chosen.
       data_dir (str, optional): The directory where the data is stored. Defaults to 'data/cylinder_flow/'.
       mode (str, optional): The mode of operation. Can be 'train', 'test', or 'val'. Defaults to 'train'.
+      num_workers (int, optional): If larger than 1, the trajectories are converted in parallel by a process pool
+        of this size, each worker saving its graphs as they are built. Defaults to 1.
 
     Returns:
       None. The function works by side effect, creating directories and saving trajectories in the specified data directory.
@@ -240,6 +254,14 @@ def constructDatasetFolders(
     traj_dir = os.path.join(data_dir, f"trajectories_{node_key}")
     if not os.path.isdir(traj_dir):
         os.mkdir(traj_dir)
+    if num_workers > 1:
+        splits = {
+            os.path.join(traj_dir, "train"): trajectories[:-2],
+            os.path.join(traj_dir, "val"): [trajectories[-2]],
+            os.path.join(traj_dir, "test"): [trajectories[-1]],
+        }
+        convert_trajectories_parallel(mode, splits, num_workers)
+        return
     train = load_trajectories(mode, trajectories[:-2], save=False)
     save_trajectory(os.path.join(traj_dir, "train"), train)
     print("training set saved")
@@ -251,7 +273,179 @@ def constructDatasetFolders(
     print("test set saved")
 
 
-def load_trajectories(filename, trajectories, save=False, save_folder=None):
+def trajectory_topology(traj):
+    """
+    Computes the static part of a trajectory from its first timestep.
+
+    Args:
+      traj (h5py.Group): The trajectory in the opened h5 file.
+
+    Returns:
+      tuple: The one-hot node types [N, NodeType.SIZE] and the edge index [2, E].
+    """
+    node_type = one_hot(traj["node_type"][0], NodeType.SIZE)
+    edges = triangles_to_edges(traj["cells"][0])
+    edge_index = torch.from_numpy(np.stack(edges)).type(torch.long)
+    return torch.from_numpy(node_type).squeeze(1), edge_index
+
+
+def iter_trajectory_window(
+    traj, trajectory, node_type, edge_index, start, stop, dt=0.01
+):
+    """
+    Yields the graphs of timesteps [start, stop) of a trajectory from one read
+    per h5 dataset, x, y and edge_attr are derived for the whole window at once.
+
+    Args:
+      traj (h5py.Group): The trajectory in the opened h5 file.
+      trajectory (string): The key of the trajectory.
+      node_type (torch.Tensor): The one-hot node types from trajectory_topology.
+      edge_index (torch.Tensor): The edge index from trajectory_topology.
+      start (int): The first timestep of the window.
+      stop (int): The timestep after the last one of the window.
+      dt (float): The time difference between two timesteps. Defaults to 0.01.
+
+    Yields:
+      Data: The graph of each timestep, in order of time.
+    """
+    num_ts = stop - start
+    # One slice per dataset instead of one read per timestep
+    velocity = torch.from_numpy(traj["velocity"][start : stop + 1])
+    pressure = torch.from_numpy(traj["pressure"][start:stop])
+    pos = torch.from_numpy(traj["pos"][start:stop])
+    cells = torch.from_numpy(traj["cells"][start:stop])
+
+    # [T, N, F] node features, edge features and node outputs
+    node_type = node_type.expand(num_ts, -1, -1)
+    x = torch.cat((velocity[:num_ts], node_type), dim=-1).type(torch.float)
+    u_ij = pos[:, edge_index[0]] - pos[:, edge_index[1]]
+    u_ij_norm = torch.norm(u_ij, p=2, dim=-1, keepdim=True)
+    edge_attr = torch.cat((u_ij, u_ij_norm), dim=-1).type(torch.float)
+    y = ((velocity[1:] - velocity[:-1]) / dt).type(torch.float)
+
+    # Clone per timestep, torch.save would otherwise store the whole window
+    # in every file as the slices share storage
+    for ts in range(num_ts):
+        yield Data(
+            x=x[ts].clone(),
+            edge_index=edge_index,
+            edge_attr=edge_attr[ts].clone(),
+            y=y[ts].clone(),
+            p=pressure[ts].clone(),
+            cells=cells[ts].clone(),
+            weights=x.new_ones(x.shape[1], 1),
+            mesh_pos=pos[ts].clone(),
+            t=start + ts,
+            trajectory=trajectory,
+        )
+
+
+def _iter_trajectory_bulk(data, trajectory, number_ts=600, dt=0.01):
+    """
+    Yields every graph of a single trajectory from one bulk read per h5 dataset.
+
+    The topology and the node types do not change within a trajectory, so the
+    one-hot node types and the edge index are computed once from the first
+    timestep, while x, y and edge_attr are derived for all timesteps at once.
+
+    Args:
+      data (h5py.File): The opened h5 file.
+      trajectory (string): The key of the trajectory to process.
+      number_ts (int): The maximum number of timesteps to process. Defaults to 600.
+      dt (float): The time difference between two timesteps. Defaults to 0.01.
+
+    Yields:
+      Data: The graph of each timestep, in order of time.
+    """
+    traj = data[trajectory]
+    num_ts = min(len(traj["velocity"]) - 1, number_ts)
+    node_type, edge_index = trajectory_topology(traj)
+    print(f"Num nodes trajectory {trajectory} : {node_type.shape[0]}")
+    yield from iter_trajectory_window(
+        traj, trajectory, node_type, edge_index, 0, num_ts, dt=dt
+    )
+
+
+def _convert_trajectory(datafile, trajectory, save_path, offset, number_ts=600):
+    """
+    Process pool worker, converts a single trajectory and saves each graph as
+    soon as it is built, such that only one trajectory is held in memory.
+
+    Args:
+      datafile (string): Path to the h5 file holding the trajectory.
+      trajectory (string): The key of the trajectory to convert.
+      save_path (string): The directory where the graphs are saved.
+      offset (int): Index of the first graph of the trajectory within its split.
+      number_ts (int): The maximum number of timesteps to convert. Defaults to 600.
+
+    Returns:
+      tuple: The trajectory and the number of graphs saved.
+    """
+    # One process per core, avoid oversubscribing with intra-op threads
+    torch.set_num_threads(1)
+    num_graphs = 0
+    with h5py.File(datafile, "r") as data:
+        graphs = _iter_trajectory_bulk(data, trajectory, number_ts=number_ts)
+        for i, g in enumerate(graphs, start=offset):
+            torch.save(g, os.path.join(save_path, f"{g.trajectory}_data_{i}.pt"))
+            num_graphs += 1
+    return trajectory, num_graphs
+
+
+def convert_trajectories_parallel(filename, splits, num_workers=None, number_ts=600):
+    """
+    Converts trajectories to graphs with a process pool, one trajectory per task.
+    Graphs are saved with the same names as save_trajectory would give them.
+
+    Args:
+      filename (string): The name of the file to load the trajectories from. It can be either 'test', 'train' or 'valid'.
+      splits (dict): Maps the directory of each split to the list of trajectories to save in it.
+      num_workers (int, optional): Size of the process pool. Defaults to the number of cores.
+      number_ts (int, optional): The maximum number of timesteps per trajectory. Defaults to 600.
+
+    Returns:
+      int: The total number of graphs saved.
+    """
+    dataset_dir = os.path.join(os.getcwd(), "data/cylinder_flow")
+    if filename not in ["test", "train", "valid"]:
+        filename = "test"
+    datafile = os.path.join(dataset_dir + f"/{filename}.h5")
+
+    # The index of a graph is global within its split, so each trajectory needs
+    # to know how many graphs the trajectories before it produce
+    tasks = []
+    with h5py.File(datafile, "r") as data:
+        for save_path, trajectories in splits.items():
+            if not os.path.isdir(save_path):
+                print("saving in folder", save_path)
+                os.mkdir(save_path)
+            offset = 0
+            for trajectory in trajectories:
+                tasks.append((datafile, trajectory, save_path, offset, number_ts))
+                offset += min(len(data[trajectory]["velocity"]) - 1, number_ts)
+
+    start = time.time()
+    total_graphs = 0
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(_convert_trajectory, *task) for task in tasks]
+        for done, future in enumerate(as_completed(futures), start=1):
+            trajectory, num_graphs = future.result()
+            total_graphs += num_graphs
+            elapsed = time.time() - start
+            logger.info(
+                f"[{done}/{len(tasks)}] trajectory {trajectory} : {num_graphs} graphs, "
+                f"{total_graphs / elapsed:.1f} graphs/s"
+            )
+    elapsed = time.time() - start
+    logger.info(
+        f"Converted {len(tasks)} trajectories ({total_graphs} graphs) in "
+        f"{elapsed:.1f}s, {len(tasks) / elapsed:.2f} trajectories/s, "
+        f"{total_graphs / elapsed:.1f} graphs/s"
+    )
+    return total_graphs
+
+
+def load_trajectories(filename, trajectories, save=False, save_folder=None, bulk=True):
     """
     This function loads the trajectories from a given file, processes them and optionally saves them in a specified folder.
 
@@ -260,6 +454,8 @@ def load_trajectories(filename, trajectories, save=False, save_folder=None):
       trajectories (list): A list of trajectories to process.
       save (boolean): A flag indicating whether to save the processed trajectories or not. Default is False.
       save_folder (string): The name of the folder where to save the processed trajectories. It is used only if save is True.
+      bulk (boolean): Read each trajectory in one slice per dataset and build the topology once,
+        set to False for meshes whose cells change over time. Default is True.
 
     Returns:
       list: A list of processed trajectories.
@@ -281,6 +477,15 @@ def load_trajectories(filename, trajectories, save=False, save_folder=None):
     with h5py.File(datafile, "r") as data:
         for trajectory in trajectories:
             print("Trajectory: ", trajectory)
+            if bulk:
+                data_list.extend(
+                    _iter_trajectory_bulk(data, trajectory, number_ts=number_ts, dt=dt)
+                )
+                if save:
+                    file = f"trajectory_{trajectory}"
+                    save_data_list(data_list, file, save_folder)
+                    data_list = []
+                continue
 
             # We iterate over all the time steps to produce an example graph except
             # for the last one, which does not have a following time step to produce
@@ -295,30 +500,16 @@ def load_trajectories(filename, trajectories, save=False, save_folder=None):
                 # import to torch from h5 format directly
                 momentum = torch.tensor(np.array(data[trajectory]["velocity"][ts]))
 
-                node_type = torch.tensor(
-                    np.array(
-                        tf.one_hot(
-                            tf.convert_to_tensor(data[trajectory]["node_type"][0]),
-                            NodeType.SIZE,
-                        )
-                    )
+                node_type = torch.from_numpy(
+                    one_hot(data[trajectory]["node_type"][0], NodeType.SIZE)
                 ).squeeze(1)
                 x = torch.cat((momentum, node_type), dim=-1).type(torch.float)
                 if ts == 0:
                     print(f"Num nodes trajectory {trajectory} : {x.shape[0]}")
 
                 # Get edge indices in COO format
-                edges = triangles_to_edges(
-                    tf.convert_to_tensor(np.array(data[trajectory]["cells"][ts]))
-                )
-
-                edge_index = torch.cat(
-                    (
-                        torch.tensor(edges[0].numpy()).unsqueeze(0),
-                        torch.tensor(edges[1].numpy()).unsqueeze(0),
-                    ),
-                    dim=0,
-                ).type(torch.long)
+                edges = triangles_to_edges(np.array(data[trajectory]["cells"][ts]))
+                edge_index = torch.from_numpy(np.stack(edges)).type(torch.long)
 
                 # Get edge features
                 u_i = torch.tensor(np.array(data[trajectory]["pos"][ts]))[edge_index[0]]
@@ -401,10 +592,8 @@ def loadh5py(filename, no_trajectories=1, save=False, save_folder=None):
             converted_node_type = np.array(
                 [nt - 3 if nt > 0 else nt for nt in data[trajectory]["node_type"][0]]
             )
-            node_type = torch.tensor(
-                np.array(
-                    tf.one_hot(tf.convert_to_tensor(converted_node_type), NodeType.SIZE)
-                )
+            node_type = torch.from_numpy(
+                one_hot(converted_node_type, NodeType.SIZE)
             ).squeeze(1)
             x = torch.cat((momentum, node_type), dim=-1).type(torch.float)
             if ts == 0:
@@ -413,28 +602,14 @@ def loadh5py(filename, no_trajectories=1, save=False, save_folder=None):
             # import to torch from h5 format directly
             momentum = torch.tensor(np.array(data[trajectory]["velocity"][ts]))
 
-            node_type = torch.tensor(
-                np.array(
-                    tf.one_hot(
-                        tf.convert_to_tensor(data[trajectory]["node_type"][0]),
-                        NodeType.SIZE,
-                    )
-                )
+            node_type = torch.from_numpy(
+                one_hot(data[trajectory]["node_type"][0], NodeType.SIZE)
             ).squeeze(1)
             x = torch.cat((momentum, node_type), dim=-1).type(torch.float)
 
             # Get edge indices in COO format
-            edges = triangles_to_edges(
-                tf.convert_to_tensor(np.array(data[trajectory]["cells"][ts]))
-            )
-
-            edge_index = torch.cat(
-                (
-                    torch.tensor(edges[0].numpy()).unsqueeze(0),
-                    torch.tensor(edges[1].numpy()).unsqueeze(0),
-                ),
-                dim=0,
-            ).type(torch.long)
+            edges = triangles_to_edges(np.array(data[trajectory]["cells"][ts]))
+            edge_index = torch.from_numpy(np.stack(edges)).type(torch.long)
 
             # Get edge features
             u_i = torch.tensor(np.array(data[trajectory]["pos"][ts]))[edge_index[0]]
@@ -502,28 +677,14 @@ def storeh5py(filename, trajectory=1):
             # import to torch from h5 format directly
             momentum = torch.tensor(np.array(data[trajectory]["velocity"][ts]))
 
-            node_type = torch.tensor(
-                np.array(
-                    tf.one_hot(
-                        tf.convert_to_tensor(data[trajectory]["node_type"][0]),
-                        NodeType.SIZE,
-                    )
-                )
+            node_type = torch.from_numpy(
+                one_hot(data[trajectory]["node_type"][0], NodeType.SIZE)
             ).squeeze(1)
             x = torch.cat((momentum, node_type), dim=-1).type(torch.float)
             h5_data["x"] = x
             # Get edge indices in COO format
-            edges = triangles_to_edges(
-                tf.convert_to_tensor(np.array(data[trajectory]["cells"][ts]))
-            )
-
-            edge_index = torch.cat(
-                (
-                    torch.tensor(edges[0].numpy()).unsqueeze(0),
-                    torch.tensor(edges[1].numpy()).unsqueeze(0),
-                ),
-                dim=0,
-            ).type(torch.long)
+            edges = triangles_to_edges(np.array(data[trajectory]["cells"][ts]))
+            edge_index = torch.from_numpy(np.stack(edges)).type(torch.long)
             h5_data["edge_index"] = edge_index
             # Get edge features
             u_i = torch.tensor(np.array(data[trajectory]["pos"][ts]))[edge_index[0]]
@@ -1,4 +1,10 @@
 import torch
+from torch.nn import functional as F
+from torch_geometric.loader import DataLoader
+
+from .stacking import stack_graphs
+
+STATS_KEYS = ["x", "edge_attr", "y"]
 
 
 def normalize(to_normalize, mean_vec, std_vec):
@@ -9,77 +15,128 @@ def unnormalize(to_unnormalize, mean_vec, std_vec):
     return to_unnormalize * std_vec + mean_vec
 
 
+class RunningStats:
+    """
+    Streaming per feature mean and variance. Chunks are summarized on their own
+    and merged with Chan et al.'s parallel update of Welford's algorithm, in
+    float64, so stats of separate chunks, e.g. computed by separate processes,
+    can be merged without loss of precision. Merging in a fixed order makes the
+    result reproducible.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, x, weight=1):
+        """Adds the rows of x, each counted weight times."""
+        x = x.reshape(-1, x.shape[-1]).double()
+        chunk = RunningStats()
+        chunk.count = x.shape[0] * weight
+        chunk.mean = x.mean(dim=0)
+        chunk.m2 = ((x - chunk.mean) ** 2).sum(dim=0) * weight
+        return self.merge(chunk)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        return self
+
+    def std(self, eps=1e-8):
+        return torch.clamp(torch.sqrt(self.m2 / self.count), min=eps)
+
+    def state_dict(self):
+        return {"count": self.count, "mean": self.mean, "m2": self.m2}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        stats = cls()
+        stats.count, stats.mean, stats.m2 = state["count"], state["mean"], state["m2"]
+        return stats
+
+
+def split_stats(data_list):
+    """
+    RunningStats of x, edge_attr and y over the graphs of data_list, in the format
+    of MeshDataset.stats, for splits that are plain lists of graphs.
+    """
+    stats = {k: RunningStats() for k in STATS_KEYS}
+    for dp in data_list:
+        for k in STATS_KEYS:
+            stats[k].update(dp[k])
+    return stats
+
+
 def get_stats(data_list):
     """
     Method for normalizing processed datasets. Given  the processed data_list,
     calculates the mean and standard deviation for the node features, edge features,
     and node outputs, and normalizes these using the calculated statistics.
     """
+    # Define a very small value for normalizing to
+    eps = 1e-8
+    stats = split_stats(data_list)
 
-    # mean and std of the node features are calculated
-    mean_vec_x = torch.zeros(data_list[0].x.shape[1:])
-    std_vec_x = torch.zeros(data_list[0].x.shape[1:])
+    mean_std_list = []
+    for k in STATS_KEYS:
+        mean_std_list += [stats[k].mean.float(), stats[k].std(eps).float()]
 
-    # mean and std of the edge features are calculated
-    mean_vec_edge = torch.zeros(data_list[0].edge_attr.shape[1:])
-    std_vec_edge = torch.zeros(data_list[0].edge_attr.shape[1:])
+    return mean_std_list
 
-    # mean and std of the output parameters are calculated
-    mean_vec_y = torch.zeros(data_list[0].y.shape[1:])
-    std_vec_y = torch.zeros(data_list[0].y.shape[1:])
 
-    # Define the maximum number of accumulations to perform such that we do
-    # not encounter memory issues
-    max_accumulations = 10**6
+class Normalizer:
+    """
+    Normalizes the node and edge features of a collated batch. Given the stats of
+    a split, {"x": RunningStats, "edge_attr": RunningStats, ...}, x and edge_attr
+    are standardized, without stats x is L2 normalized per node.
+    """
 
-    # Define a very small value for normalizing to
-    eps = torch.tensor(1e-8)
+    def __init__(self, stats=None, eps=1e-8):
+        self.stats = stats
+        if stats is not None:
+            self.mean_x = stats["x"].mean.float()
+            self.std_x = stats["x"].std(eps).float()
+            self.mean_edge = stats["edge_attr"].mean.float()
+            self.std_edge = stats["edge_attr"].std(eps).float()
 
-    # Define counters used in normalization
-    num_accs_x = 0
-    num_accs_edge = 0
-    num_accs_y = 0
+    def __call__(self, b_data):
+        if self.stats is None:
+            b_data.x = F.normalize(b_data.x, dim=-1)
+            return b_data
+        device = b_data.x.device
+        b_data.x = normalize(b_data.x, self.mean_x.to(device), self.std_x.to(device))
+        b_data.edge_attr = normalize(
+            b_data.edge_attr, self.mean_edge.to(device), self.std_edge.to(device)
+        )
+        return b_data
 
-    # Iterate through the data in the list to accumulate statistics
-    for dp in data_list:
-        # Add to the
-        mean_vec_x += torch.sum(dp.x, dim=0)
-        std_vec_x += torch.sum(dp.x**2, dim=0)
-        num_accs_x += dp.x.shape[0]
-
-        mean_vec_edge += torch.sum(dp.edge_attr, dim=0)
-        std_vec_edge += torch.sum(dp.edge_attr**2, dim=0)
-        num_accs_edge += dp.edge_attr.shape[0]
-
-        mean_vec_y += torch.sum(dp.y, dim=0)
-        std_vec_y += torch.sum(dp.y**2, dim=0)
-        num_accs_y += dp.y.shape[0]
-
-        if (
-            num_accs_x > max_accumulations
-            or num_accs_edge > max_accumulations
-            or num_accs_y > max_accumulations
-        ):
-            break
-
-    mean_vec_x = mean_vec_x / num_accs_x
-    std_vec_x = torch.maximum(torch.sqrt(std_vec_x / num_accs_x - mean_vec_x**2), eps)
-
-    mean_vec_edge = mean_vec_edge / num_accs_edge
-    std_vec_edge = torch.maximum(
-        torch.sqrt(std_vec_edge / num_accs_edge - mean_vec_edge**2), eps
-    )
-
-    mean_vec_y = mean_vec_y / num_accs_y
-    std_vec_y = torch.maximum(torch.sqrt(std_vec_y / num_accs_y - mean_vec_y**2), eps)
-
-    mean_std_list = [
-        mean_vec_x,
-        std_vec_x,
-        mean_vec_edge,
-        std_vec_edge,
-        mean_vec_y,
-        std_vec_y,
-    ]
 
-    return mean_std_list
+class NormalizingCollater:
+    def __init__(self, collater, normalizer):
+        self.collater = collater
+        self.normalizer = normalizer
+
+    def __call__(self, batch):
+        return self.normalizer(self.collater(batch))
+
+
+class NormalizedDataLoader(DataLoader):
+    """
+    DataLoader normalizing every batch once, right after it is collated. With
+    stack the snapshots of a batch, all on one mesh, are collated by stack_graphs
+    into a feature stacked batch.
+    """
+
+    def __init__(self, dataset, normalizer, stack=False, **kwargs):
+        super().__init__(dataset, **kwargs)
+        collater = stack_graphs if stack else self.collate_fn
+        self.collate_fn = NormalizingCollater(collater, normalizer)
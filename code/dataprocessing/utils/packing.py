@@ -0,0 +1,108 @@
+import os
+import re
+
+import torch
+from torch_geometric.data import Data
+
+PACKED_VERSION = 1
+PACKED_SUFFIX = "_packed.pt"
+# Identical for every timestep of a trajectory, stored once per container
+STATIC_KEYS = ["edge_index", "edge_attr", "cells", "mesh_pos", "weights"]
+# Stored as contiguous [T, N, F] tensors
+DYNAMIC_KEYS = ["x", "y", "p"]
+
+
+def pack_graphs(graphs):
+    """
+    Packs the graphs of a single trajectory into one container.
+
+    Args:
+      graphs (list): The graphs of the trajectory, sorted by time.
+
+    Returns:
+      dict: The static topology once and the dynamic fields as [T, N, F] tensors.
+    """
+    first = graphs[0]
+    packed = {
+        "version": PACKED_VERSION,
+        "trajectory": first.trajectory,
+        "t": torch.tensor([g.t for g in graphs], dtype=torch.long),
+    }
+    for key in STATIC_KEYS:
+        for g in graphs:
+            if not torch.equal(g[key], first[key]):
+                raise ValueError(
+                    f"{key} of trajectory {first.trajectory} changes at t={g.t}, "
+                    "only static meshes can be packed"
+                )
+        packed[key] = first[key]
+    for key in DYNAMIC_KEYS:
+        packed[key] = torch.stack([g[key] for g in graphs])
+    return packed
+
+
+def unpack_graph(packed, i):
+    """
+    Returns the graph of the i'th timestep in a packed trajectory, the tensors
+    are views into the container.
+    """
+    return Data(
+        x=packed["x"][i],
+        edge_index=packed["edge_index"],
+        edge_attr=packed["edge_attr"],
+        y=packed["y"][i],
+        p=packed["p"][i],
+        cells=packed["cells"],
+        weights=packed["weights"],
+        mesh_pos=packed["mesh_pos"],
+        t=int(packed["t"][i]),
+        trajectory=packed["trajectory"],
+    )
+
+
+def load_packed(file, mmap=False):
+    """
+    Loads a packed trajectory. With mmap the tensors are views into the memory
+    mapped file, nothing is deserialized or copied until a page is read, and
+    processes loading the same file share the page cache. The mapping is
+    private, so an in-place write only changes the writing process' copy.
+    """
+    packed = torch.load(file, mmap=mmap)
+    if packed.get("version") != PACKED_VERSION:
+        raise ValueError(
+            f"{file} has packed version {packed.get('version')}, expected {PACKED_VERSION}"
+        )
+    return packed
+
+
+def pack_split(split_dir, remove=False):
+    """
+    Packs every trajectory of a split folder, containing {traj}_data_{i}.pt files,
+    into a {traj}_packed.pt container.
+
+    Args:
+      split_dir (str): The folder of the split, e.g. data/cylinder_flow/trajectories_1768/train.
+      remove (bool): Whether to remove the per timestep files once packed. Defaults to False.
+    """
+    trajectory_files = {}
+    for f in os.listdir(split_dir):
+        if f.endswith(PACKED_SUFFIX):
+            continue
+        t = re.search(r"\d+", f).group()
+        trajectory_files.setdefault(t, []).append(f)
+    for t, files in trajectory_files.items():
+        # Pickled Data objects written by the conversion, trusted local files
+        graphs = [
+            torch.load(os.path.join(split_dir, f), weights_only=False) for f in files
+        ]
+        graphs.sort(key=lambda g: g.t)
+        torch.save(pack_graphs(graphs), os.path.join(split_dir, f"{t}{PACKED_SUFFIX}"))
+        if remove:
+            for f in files:
+                os.remove(os.path.join(split_dir, f))
+
+
+def pack_dataset(data_dir="data/cylinder_flow", trajectories="trajectories_1768"):
+    folder = os.path.join(data_dir, trajectories)
+    for split in ["train", "val", "test"]:
+        pack_split(os.path.join(folder, split), remove=True)
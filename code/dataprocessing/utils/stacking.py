@@ -0,0 +1,39 @@
+import torch
+from torch_geometric.data import Data
+
+# Identical for every snapshot of a trajectory, stored once in a stacked batch
+STATIC_KEYS = ["edge_index", "edge_attr", "cells", "mesh_pos", "weights"]
+# Stacked as [B, N, F] tensors
+DYNAMIC_KEYS = ["x", "y", "p"]
+
+
+def stack_graphs(graphs):
+    """
+    Collates snapshots of a single trajectory into a feature stacked batch, the
+    node features of all snapshots stacked as [B, N, F] over one edge_index, instead
+    of B copies of the graph with offset edges. Used as collate_fn for same
+    topology batches, e.g. when training on one trajectory.
+
+    Args:
+      graphs (list): The snapshots, all of the same trajectory.
+
+    Returns:
+      Data: The static fields once, x, y and p as [B, N, F], t as a tensor of the
+      times and trajectory as a single string.
+    """
+    first = graphs[0]
+    for g in graphs:
+        if g.trajectory != first.trajectory:
+            raise ValueError(
+                f"Snapshots of trajectories {first.trajectory} and {g.trajectory}, "
+                "only snapshots of one trajectory can be stacked"
+            )
+    stacked = {key: first[key] for key in STATIC_KEYS}
+    for key in DYNAMIC_KEYS:
+        stacked[key] = torch.stack([g[key] for g in graphs])
+    return Data(
+        **stacked,
+        t=torch.tensor([g.t for g in graphs], dtype=torch.long),
+        trajectory=first.trajectory,
+        num_nodes=first.num_nodes,
+    )
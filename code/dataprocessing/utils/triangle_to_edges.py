@@ -1,17 +1,47 @@
 import enum
 
-import tensorflow as tf
+import numpy as np
 
 # Utility functions, provided in the release of the code from the original MeshGraphNets study:
 # https://github.com/deepmind/deepmind-research/tree/master/meshgraphnets
 
 
 def triangles_to_edges(faces):
+    """Computes mesh edges from triangles.
+    NumPy port of tf_triangles_to_edges, the unique edges are kept in order of
+    first occurrence like tf.unique does, such that the resulting edge index is
+    identical to the one of the TensorFlow version.
+    """
+    faces = np.asarray(faces)
+    # collect edges from triangles
+    edges = np.concatenate(
+        [faces[:, 0:2], faces[:, 1:3], np.stack([faces[:, 2], faces[:, 0]], axis=1)],
+        axis=0,
+    )
+    # those edges are sometimes duplicated (within the mesh) and sometimes
+    # single (at the mesh boundary).
+    # sort edges & remove duplicates, keeping the order of first occurrence
+    receivers = np.min(edges, axis=1)
+    senders = np.max(edges, axis=1)
+    packed_edges = np.stack([senders, receivers], axis=1)
+    _, first = np.unique(packed_edges, axis=0, return_index=True)
+    senders, receivers = packed_edges[np.sort(first)].T
+    # create two-way connectivity
+    return (
+        np.concatenate([senders, receivers], axis=0),
+        np.concatenate([receivers, senders], axis=0),
+    )
+
+
+def tf_triangles_to_edges(faces):
     """Computes mesh edges from triangles.
     Note that this triangles_to_edges method was provided as part of the
     code release for the MeshGraphNets paper by DeepMind, available here:
     https://github.com/deepmind/deepmind-research/tree/master/meshgraphnets
+    Kept as reference for triangles_to_edges, TensorFlow is only imported here.
     """
+    import tensorflow as tf
+
     # collect edges from triangles
     edges = tf.concat(
         [faces[:, 0:2], faces[:, 1:3], tf.stack([faces[:, 2], faces[:, 0]], axis=1)],
@@ -33,6 +63,12 @@ def triangles_to_edges(faces):
     )
 
 
+def one_hot(indices, depth):
+    """NumPy equivalent of tf.one_hot, indices outside [0, depth) give a row of zeros."""
+    indices = np.asarray(indices)
+    return (indices[..., None] == np.arange(depth)).astype(np.float32)
+
+
 class NodeType(enum.IntEnum):
     """
     Define the code for the one-hot vector representing the node types.
@@ -1,24 +1,30 @@
+import copy
+from collections import OrderedDict
+
 import torch
+from dataprocessing.utils.hierarchy import BATCH_CACHE_SIZE, MeshHierarchy
 from loguru import logger
-from model.utility import MessagePassingLayer, Unpool
+from model.utility import (
+    MessagePassingLayer,
+    Unpool,
+    graph_keys,
+    is_stacked,
+    reslice_batch,
+)
 from torch import nn
 from torch.nn import SELU, LayerNorm, Linear, Sequential
-from torch_geometric.data import Batch
+from torch_geometric.data import Batch, Data
 from torch_geometric.nn.norm import BatchNorm
-from torch_geometric.nn.unpool import knn_interpolate
 
 
 class Decoder(nn.Module):
-    def __init__(self, args, m_ids, m_gs, e_s, m_pos, graph_placeholder):
+    def __init__(self, args, hierarchies, graph_placeholder):
         """
         Initializes the Decoder class.
 
         Args:
             args: The arguments for the model.
-            m_ids: The node IDs.
-            m_gs: The node graphs.
-            e_s: The edge indices.
-            m_pos: The node positions.
+            hierarchies: The MeshHierarchy of every trajectory.
             graph_placeholder: The graph placeholder.
         """
         super(Decoder, self).__init__()
@@ -28,7 +34,9 @@ class Decoder(nn.Module):
         self.latent_dim = args.latent_dim
         self.max_hidden_dim = args.hidden_dim * 2**args.ae_layers
         # Pre computed node mask and edge_mask from bi-stride pooling
-        self.m_ids, self.m_gs, self.e_s = m_ids, m_gs, e_s
+        self.hierarchies = hierarchies
+        # Trajectories of a batch -> its collated static graphs on the device
+        self._batch_templates = OrderedDict()
         self.ae_layers = args.ae_layers
         self.n = args.n_nodes
         self.layers = nn.ModuleList()
@@ -50,20 +58,13 @@ class Decoder(nn.Module):
 
         for i in range(self.ae_layers):
             up_idx = args.ae_layers - i - 1
-            if i == self.ae_layers - 1:
-                up_nodes = self.n
-            else:
-                up_nodes = m_ids[up_idx - 1]
             self.layers.append(
                 Res_up(
                     channel_in=self.max_hidden_dim // 2**i,
                     channel_out=self.max_hidden_dim // 2 ** (i + 1),
                     args=args,
-                    m_id=m_ids[up_idx],
-                    m_g=m_gs[up_idx],
-                    e_idx=e_s[up_idx],
-                    up_nodes=up_nodes,
-                    m_pos_new=m_pos[up_idx],
+                    hierarchies=hierarchies,
+                    level=up_idx,
                 )
             )
 
@@ -77,35 +78,74 @@ class Decoder(nn.Module):
             LayerNorm(self.out_feature_dim),
         )
 
+    def _batch_template(self, trajectories):
+        """
+        The coarsest graphs of a batch of trajectories collated once and kept on
+        the device, edge_index, weights, mesh_pos, cells and the batch vector,
+        without node features. Only the trajectories it was built for, in order and
+        of the same batch size, reuse it. The single trajectory of a feature stacked
+        batch gets its graph as a Data, shared by all of its snapshots.
+        """
+        stacked = isinstance(trajectories, str)
+        key = trajectories if stacked else tuple(trajectories)
+        if key in self._batch_templates:
+            self._batch_templates.move_to_end(key)
+            return self._batch_templates[key]
+        graphs = []
+        for t in [key] if stacked else key:
+            placeholder = self.graph_placeholder[t]
+            graphs.append(
+                Data(
+                    x=placeholder.x[:, :0],
+                    edge_index=placeholder.edge_index,
+                    weights=placeholder.weights,
+                    mesh_pos=placeholder.mesh_pos,
+                    cells=placeholder.cells,
+                    trajectory=t,
+                )
+            )
+        template = graphs[0] if stacked else Batch.from_data_list(graphs)
+        template = template.to(self.args.device)
+        self._batch_templates[key] = template
+        if len(self._batch_templates) > BATCH_CACHE_SIZE:
+            self._batch_templates.popitem(last=False)
+        return template
+
     def construct_batch(self, latent_vec):
-        b_lst = []
-        for z, t in latent_vec:
-            graph = self.graph_placeholder[t].clone()
-            node_mask = self.m_ids[-1][t]
-            graph.x = z[: len(node_mask)]
-            b_lst.append(graph)
-        return Batch.from_data_list(b_lst).to(self.args.device)
+        # A shallow copy shares the template's tensors, only x is new
+        b_data = copy.copy(self._batch_template(latent_vec.t))
+        if isinstance(latent_vec.t, str):
+            # The snapshots of a feature stacked batch, x [B, N, F]
+            n = self.hierarchies[latent_vec.t].num_nodes[-1]
+            b_data.x = latent_vec.z[:, :n]
+            return b_data
+        num_nodes = [self.hierarchies[t].num_nodes[-1] for t in latent_vec.t]
+        b_data.x = torch.cat([z[:n] for z, n in zip(latent_vec.z, num_nodes)])
+        return b_data
 
     def forward(self, latent_vec):
         latent_vec.z = self.up_mlp(latent_vec.z).transpose(1, 2)
         latent_vec.z = self.latent_up_mlp(latent_vec.z)
         # Should be shape (B, |V|_max, latent_dim):
         b_data = self.construct_batch(latent_vec)
-        b_data = self.mpl_bottom(b_data)
+        b_data = self.mpl_bottom(
+            b_data,
+            graph_keys(b_data, self.hierarchies, self.ae_layers, "placeholder"),
+        )
         for i in range(self.ae_layers):
             b_data = self.layers[i](b_data)
             if torch.any(torch.isnan(b_data.x)):
                 logger.error(f"something is nan in decoder path no {i}")
                 exit()
-        b_data = self.final_layer(b_data)
+        b_data = self.final_layer(
+            b_data, graph_keys(b_data, self.hierarchies, 0, "placeholder")
+        )
         b_data.x = self.out_node_decoder(b_data.x)
         return b_data
 
 
 class Res_up(nn.Module):
-    def __init__(
-        self, channel_in, channel_out, args, m_id, m_g, e_idx, up_nodes, m_pos_new
-    ):
+    def __init__(self, channel_in, channel_out, args, hierarchies, level):
         """
         Initialize the Res_up class, Message Passing layers + upsampling with residual connections
         from layer l -> l-1.
@@ -114,22 +154,16 @@ class Res_up(nn.Module):
             channel_in (int): Number of input channels.
             channel_out (int): Number of output channels.
             args: Additional arguments.
-            m_id: Identifier of the model.
-            m_g: Model graph.
-            e_idx: Edge index.
-            up_nodes: Up nodes.
-            m_pos_new: New model position.
+            hierarchies: The MeshHierarchy of every trajectory.
+            level (int): The level upsampled to, from level + 1.
 
         Returns:
             None
         """
         super(Res_up, self).__init__()
-        self.m_id = m_id
-        self.m_g = m_g
-        self.e_idx = e_idx
+        self.hierarchies = hierarchies
+        self.level = level
         self.args = args
-        self.up_nodes = up_nodes
-        self.m_pos_new = m_pos_new
         self.mpl1 = MessagePassingLayer(channel_in, channel_out // 2, args)
         self.mpl2 = MessagePassingLayer(channel_out // 2, channel_out, args)
         self.mpl_skip = MessagePassingLayer(channel_in, channel_out, args)
@@ -139,32 +173,41 @@ class Res_up(nn.Module):
         self.bn_nodes = BatchNorm(in_channels=channel_out)
 
     def _bi_up_pool_batch(self, b_data):
-        b_lst = b_data.to_data_list()
-        batch_lst = []
-        for idx, data in enumerate(b_lst):
-            g, mask = self.m_g[data.trajectory], self.m_id[data.trajectory]
-            up_nodes = (
-                self.up_nodes
-                if isinstance(self.up_nodes, int)
-                else len(self.up_nodes[data.trajectory])
+        stacked = is_stacked(b_data)
+        trajectories = [b_data.trajectory] if stacked else b_data.trajectory
+        hierarchies = [self.hierarchies[t].to(self.args.device) for t in trajectories]
+        fine = MeshHierarchy.batch_level(hierarchies, self.level)
+        # The precomputed kNN interpolation of every graph as one block diagonal
+        # sparse matmul
+        if stacked:
+            # The snapshots side by side, [N, B * F], in the same matmul
+            x = b_data.x
+            up = torch.sparse.mm(
+                fine["interpolation"], x.transpose(0, 1).reshape(x.shape[1], -1)
             )
-            m_pos = self.m_pos_new[data.trajectory].to(self.args.device)
-
-            data.x = knn_interpolate(data.x, data.mesh_pos, m_pos)
-            data.mesh_pos = m_pos
-            data.weights = self.unpool(data.weights, up_nodes, mask)
-            data.edge_index = g
-            batch_lst.append(data)
-        b_data = Batch.from_data_list(batch_lst).to(self.args.device)
-        return b_data
+            b_data.x = up.view(up.shape[0], x.shape[0], -1).transpose(0, 1)
+        else:
+            b_data.x = torch.sparse.mm(fine["interpolation"], b_data.x)
+        b_data.mesh_pos = fine["mesh_pos"]
+        b_data.weights = self.unpool(
+            b_data.weights, int(fine["num_nodes"].sum()), fine["m_ids"]
+        )
+        b_data.edge_index = fine["edge_index"]
+        if stacked:
+            return b_data
+        return reslice_batch(b_data, fine["num_nodes"], fine["num_edges"])
 
     def forward(self, b_data):
-        b_skip = self.mpl_skip(self._bi_up_pool_batch(b_data.clone()))
-        b_data = self.mpl1(b_data)
+        keys = graph_keys(b_data, self.hierarchies, self.level + 1, "placeholder")
+        up_keys = graph_keys(b_data, self.hierarchies, self.level, "placeholder")
+        b_skip = self.mpl_skip(self._bi_up_pool_batch(b_data.clone()), up_keys)
+        b_data = self.mpl1(b_data, keys)
         b_data = self._bi_up_pool_batch(b_data)
-        b_data = self.mpl2(b_data)
+        b_data = self.mpl2(b_data, up_keys)
         b_data.x = b_data.x + b_skip.x
         if self.args.batch_norm:
-            b_data.x = self.bn_nodes(b_data.x)
+            # over the nodes of all snapshots of a feature stacked batch
+            x = b_data.x
+            b_data.x = self.bn_nodes(x.reshape(-1, x.shape[-1])).view_as(x)
         b_data.x = self.act1(b_data.x)
         return b_data
@@ -1,31 +1,34 @@
 import torch
+from dataprocessing.utils.hierarchy import MeshHierarchy
 from loguru import logger
 from model.utility import (
     LatentVecLayer,
     LatentVector,
     MessagePassingLayer,
     Unpool,
+    graph_keys,
+    is_stacked,
+    reslice_batch,
+    topk_pool_stacked,
 )
 from torch import nn
 from torch.nn import SELU, LayerNorm, Linear, Sequential
-from torch_geometric.data import Batch
 from torch_geometric.nn.norm import BatchNorm
 from torch_geometric.nn.pool import TopKPooling
 
 
 class Encoder(nn.Module):
-    def __init__(self, args, m_ids, m_gs):
+    def __init__(self, args, hierarchies):
         """
         Initialize the Encoder class.
 
         Args:
             args: The arguments for the Encoder.
-            m_ids: The module IDs.
-            m_gs: The module GS.
+            hierarchies: The MeshHierarchy of every trajectory.
         """
         super(Encoder, self).__init__()
         self.args = args
-        self.m_ids, self.m_gs = m_ids, m_gs
+        self.hierarchies = hierarchies
         self.ae_layers = args.ae_layers
         self.hidden_dim = args.hidden_dim
         self.latent_dim = args.latent_dim
@@ -51,8 +54,8 @@ class Encoder(nn.Module):
                 Res_down(
                     channel_in=self.hidden_dim * 2**i,
                     channel_out=self.hidden_dim * 2 ** (i + 1),
-                    m_id=self.m_ids[i],
-                    m_g=self.m_gs[i + 1],
+                    hierarchies=self.hierarchies,
+                    level=i,
                     args=args,
                     ratio=ratio,
                 )
@@ -83,8 +86,12 @@ class Encoder(nn.Module):
         for i in range(self.ae_layers):
             b_data = self.layers[i](b_data)
 
-        # Bottom layer message passing
-        b_data = self.bottom_layer(b_data)
+        # Bottom layer message passing, on the coarsest level of the hierarchies
+        # with the bi-stride pooling
+        keys = None
+        if self.args.bi_stride_pool:
+            keys = graph_keys(b_data, self.hierarchies, self.ae_layers, "data")
+        b_data = self.bottom_layer(b_data, keys)
         if Train:
             # (B, |V_L|, H) -> (B, 1, Latent dim)
             x_t = self.node_latent_mlp(b_data).transpose(1, 2)
@@ -134,15 +141,15 @@ class Res_down(nn.Module):
         channel_in (int): Number of input channels.
         channel_out (int): Number of output channels.
         args: Additional arguments.
-        m_id: Identifier for the model.
-        m_g: Graph for the model.
+        hierarchies: The MeshHierarchy of every trajectory.
+        level (int): The level pooled from, to level + 1.
         ratio (float, optional): Ratio for pooling. Defaults to 0.5.
     """
 
-    def __init__(self, channel_in, channel_out, args, m_id, m_g, ratio=0.5):
+    def __init__(self, channel_in, channel_out, args, hierarchies, level, ratio=0.5):
         super(Res_down, self).__init__()
-        self.m_id = m_id
-        self.m_g = m_g
+        self.hierarchies = hierarchies
+        self.level = level
         self.args = args
         self.mpl1 = MessagePassingLayer(channel_in, channel_out // 2, args)
         self.mpl2 = MessagePassingLayer(channel_out // 2, channel_out, args)
@@ -154,51 +161,77 @@ class Res_down(nn.Module):
         self.pool = TopKPooling(in_channels=channel_out // 2, ratio=ratio)
 
     def _learnable_pool(self, b_data, skip=False):
-        b_lst = Batch.to_data_list(b_data)
-        data_lst = []
-        for idx, data in enumerate(b_lst):
-            if skip:
-                x, edge_index, _, _, perm, _ = self.pool_skip(
-                    x=data.x, edge_index=data.edge_index
-                )
-            else:
-                x, edge_index, _, _, perm, _ = self.pool(
-                    x=data.x, edge_index=data.edge_index
-                )
-            data.x = x
-            data.edge_index = edge_index
-            data.mesh_pos = data.mesh_pos[perm]
-            data.weights = data.weights[perm]
-            data_lst.append(data)
-        return Batch.from_data_list(data_lst).to(self.args.device)
+        pool = self.pool_skip if skip else self.pool
+        if is_stacked(b_data):
+            # The same nodes kept for every snapshot
+            x, edge_index, perm = topk_pool_stacked(pool, b_data.x, b_data.edge_index)
+            b_data.x = x
+            b_data.edge_index = edge_index
+            b_data.mesh_pos = b_data.mesh_pos[perm]
+            b_data.weights = b_data.weights[perm]
+            return b_data
+        # A single TopKPooling over the whole batch, the top nodes are selected per
+        # graph through the batch vector, and perm indexes the batched node tensors
+        x, edge_index, _, batch, perm, _ = pool(
+            x=b_data.x, edge_index=b_data.edge_index, batch=b_data.batch
+        )
+        b_data.x = x
+        b_data.edge_index = edge_index
+        b_data.mesh_pos = b_data.mesh_pos[perm]
+        b_data.weights = b_data.weights[perm]
+        num_graphs = b_data.num_graphs
+        return reslice_batch(
+            b_data,
+            torch.bincount(batch, minlength=num_graphs),
+            torch.bincount(batch[edge_index[0]], minlength=num_graphs),
+        )
 
     def _bi_pool_batch(self, b_data):
-        b_lst = Batch.to_data_list(b_data)
-        data_lst = []
-
-        for idx, data in enumerate(b_lst):
-            g = self.m_g[data.trajectory]
-            mask = self.m_id[data.trajectory]
-            data.x = data.x[mask]
-            data.mesh_pos = data.mesh_pos[mask]
-            data.weights = data.weights[mask]
-            data.edge_index = g
-            data_lst.append(data)
-        return Batch.from_data_list(data_lst).to(self.args.device)
+        stacked = is_stacked(b_data)
+        trajectories = [b_data.trajectory] if stacked else b_data.trajectory
+        hierarchies = [self.hierarchies[t].to(self.args.device) for t in trajectories]
+        # The kept nodes of every graph as one index into the batch and the coarse
+        # edges offset per graph, both collated once per batch composition
+        fine = MeshHierarchy.batch_level(hierarchies, self.level)
+        coarse = MeshHierarchy.batch_level(hierarchies, self.level + 1)
+        mask = fine["m_ids"]
+        b_data.x = b_data.x[..., mask, :]
+        b_data.mesh_pos = b_data.mesh_pos[mask]
+        b_data.weights = b_data.weights[mask]
+        b_data.edge_index = coarse["edge_index"]
+        if stacked:
+            return b_data
+        return reslice_batch(b_data, coarse["num_nodes"], coarse["num_edges"])
+
+    def _pool(self, b_data, skip=False):
+        # The fixed bi-stride pooling keeps the same nodes on the skip connection
+        if self.args.bi_stride_pool:
+            return self._bi_pool_batch(b_data)
+        return self._learnable_pool(b_data, skip=skip)
+
+    def _graph_keys(self, b_data, level):
+        # The graphs are levels of the hierarchies up to the first learnable pooling
+        if level == 0 or self.args.bi_stride_pool:
+            return graph_keys(b_data, self.hierarchies, level, "data")
+        return None
 
     def forward(self, b_data):
         # Removed edge_attr
         if torch.any(torch.isnan(b_data.x)):
             logger.error("something is nan in start of Res_down")
+        keys = self._graph_keys(b_data, self.level)
+        pooled_keys = self._graph_keys(b_data, self.level + 1)
         # NOTE: Implemented learnable pooling
-        b_skip = self._learnable_pool(b_data.clone(), skip=True)
-        b_skip = self.mpl_skip(b_skip)  # out = channel_out
-        b_data = self.mpl1(b_data)
-        b_data = self._learnable_pool(b_data)
-        b_data = self.mpl2(b_data)
+        b_skip = self._pool(b_data.clone(), skip=True)
+        b_skip = self.mpl_skip(b_skip, pooled_keys)  # out = channel_out
+        b_data = self.mpl1(b_data, keys)
+        b_data = self._pool(b_data)
+        b_data = self.mpl2(b_data, pooled_keys)
         b_data.x = b_data.x + b_skip.x
         if self.args.batch_norm:
-            b_data.x = self.bn_nodes(b_data.x)
+            # over the nodes of all snapshots of a feature stacked batch
+            x = b_data.x
+            b_data.x = self.bn_nodes(x.reshape(-1, x.shape[-1])).view_as(x)
         b_data.x = self.act1(b_data.x)
         if torch.any(torch.isnan(b_data.x)):
             logger.error("something is nan at the end of Res_down")
@@ -19,11 +19,11 @@ class MultiScaleAutoEncoder(nn.Module):
     Decode: G_l -> MPL -> Unpool .... -> MPL -> MLP -> G'_0 ->
     """
 
-    def __init__(self, args, m_ids, m_gs, e_s, m_pos, graph_placeholder):
+    def __init__(self, args, hierarchies, graph_placeholder):
         super().__init__()
         self.args = args
-        self.encoder = Encoder(args, m_ids, m_gs)
-        self.decoder = Decoder(args, m_ids, m_gs, e_s, m_pos, graph_placeholder)
+        self.encoder = Encoder(args, hierarchies)
+        self.decoder = Decoder(args, hierarchies, graph_placeholder)
 
     def forward(self, b_data, Train=True):
         kl, latent_vec, b_data = self.encoder(b_data, Train)
@@ -1,13 +1,12 @@
 from dataclasses import dataclass
 
 import numpy as np
-import scipy
 import torch
 from torch import nn
 from torch.nn import LayerNorm, LeakyReLU, Linear, ReLU, Sequential
 from torch_geometric.nn.conv import GraphConv, MessagePassing, SAGEConv
 from torch_geometric.nn.pool import ASAPooling, SAGPooling, TopKPooling
-from torch_geometric.utils import coalesce, degree, to_dense_adj
+from torch_geometric.utils import coalesce, degree
 from torch_scatter import scatter
 
 
@@ -33,45 +32,36 @@ def pool_edge(m_id, edge_index, edge_attr: torch.Tensor, aggr: str = "mean"):
     return edge_index, edge_attr
 
 
-def _adj_mat_to_flat_edge(adj_mat):
-    if len(adj_mat.shape) == 2:
-        s, r = np.where(adj_mat)
-        return torch.tensor(np.array([s, r]), dtype=torch.int64)
-    elif len(adj_mat.shape) == 3:
-        s, r, p = np.where(adj_mat.astype(bool))
-        return torch.tensor([s, r, p], dtype=torch.int64)
-
-
-def adj_degree(g):
-    # For efficiency
-    g = scipy.sparse.coo_array(g)
-    g.setdiag(1)
-    # Compressed sparse row format
-    g = g.tocsr().astype(float)
+def adj_degree(edge_index, num_nodes):
+    """
+    The edges of the squared adjacency with self loops, the nodes within two hops of
+    each other, without the diagonal. Sparse and on the device of edge_index.
 
-    # Dot product/matrix multiplication
-    g = g @ g
-    g.setdiag(0)
-    return g.toarray()
+    Returns:
+        torch.Tensor: The edges [2, E'] in row major order.
+    """
+    loops = torch.arange(num_nodes, device=edge_index.device).repeat(2, 1)
+    indices = torch.cat([edge_index, loops], dim=1)
+    g = torch.sparse_coo_tensor(
+        indices,
+        torch.ones(indices.shape[1], device=edge_index.device),
+        (num_nodes, num_nodes),
+    ).coalesce()
+    g = torch.sparse.mm(g, g).coalesce().indices()
+    return g[:, g[0] != g[1]]
 
 
 def unpool_edge(edge_index, edge_attr, e_idx, args):
-    g = to_dense_adj(edge_index).detach().numpy().squeeze()
-    # Matrix Magic
-    g = adj_degree(g)
-    # To Flat Edge
-    g = _adj_mat_to_flat_edge(g)
+    num_nodes = int(edge_index.max()) + 1
+    # Edges within two hops, the edges pooled from
+    g = adj_degree(edge_index, num_nodes)
     # Create empty array of all possible edges
-    new_edge_attr = torch.zeros(
-        (g.shape[1], edge_attr.shape[-1]), dtype=torch.float32
-    ).to(args.device)
-    # Creates a 1d list of the 2d list
-    c = g.T[:, 0] + g.T[:, 1] * 1j
-    # Creates a 1d list of the 2d list
-    d = edge_index.T[:, 0] + edge_index.T[:, 1] * 1j
-    # Mask out actual edges
-    res = np.in1d(c, d)
-    mask = np.where(res)[0]
+    new_edge_attr = edge_attr.new_zeros((g.shape[1], edge_attr.shape[-1]))
+    # Edges packed as single int64 keys, the actual edges found by sorted search
+    keys = g[0] * num_nodes + g[1]
+    edge_keys = torch.unique(edge_index[0] * num_nodes + edge_index[1])
+    pos = torch.searchsorted(edge_keys, keys).clamp(max=len(edge_keys) - 1)
+    mask = edge_keys[pos] == keys
     # Fill out edge attributes of prev resolution
     new_edge_attr[e_idx, :] = edge_attr
     # Mask edge_attributes
@@ -80,6 +70,122 @@ def unpool_edge(edge_index, edge_attr, e_idx, args):
     return new_edge_index, new_edge_attr
 
 
+def reslice_batch(b_data, num_nodes, num_edges, node_keys=("x", "weights", "mesh_pos")):
+    """
+    Updates batch, ptr and the slices of a Batch whose node and edge tensors were
+    replaced by those of another level, so it can still be split by to_data_list.
+
+    Args:
+        b_data (Batch): The batch, with the new node and edge tensors set.
+        num_nodes (torch.Tensor): The new number of nodes of every graph.
+        num_edges (torch.Tensor): The new number of edges of every graph.
+        node_keys (tuple, optional): The node level attributes that were replaced.
+
+    Returns:
+        Batch: The batch.
+    """
+    node_ptr = torch.cat([num_nodes.new_zeros(1), num_nodes.cumsum(0)])
+    edge_ptr = torch.cat([num_edges.new_zeros(1), num_edges.cumsum(0)])
+    device = b_data.x.device
+    b_data.batch = torch.repeat_interleave(
+        torch.arange(len(num_nodes), device=device), num_nodes.to(device)
+    )
+    b_data.ptr = node_ptr.to(device)
+    # New dicts rather than updated ones, a shallow copy of a Batch shares them
+    b_data._slice_dict = {
+        **b_data._slice_dict,
+        **{key: node_ptr for key in node_keys},
+        "edge_index": edge_ptr,
+    }
+    b_data._inc_dict = {**b_data._inc_dict, "edge_index": node_ptr[:-1]}
+    return b_data
+
+
+def is_stacked(b_data):
+    """
+    Whether b_data holds the feature stacked snapshots of a single graph, x of shape
+    [B, N, F] over one edge_index, see stack_graphs, instead of a collated Batch.
+    """
+    return b_data.x.dim() == 3
+
+
+def topk_pool_stacked(pool, x, edge_index):
+    """
+    TopKPooling of feature stacked snapshots x [B, N, F] of one graph. Every
+    snapshot keeps the same nodes, the top nodes by the score of the mean features,
+    so the pooled snapshots share one edge_index as well.
+
+    Returns:
+        (torch.Tensor, torch.Tensor, torch.Tensor): The pooled x, edge_index and
+        the kept nodes.
+    """
+    select_out = pool.select(x.mean(dim=0))
+    perm = select_out.node_index
+    x = x[:, perm] * select_out.weight.view(1, -1, 1)
+    x = pool.multiplier * x if pool.multiplier != 1 else x
+    edge_index = pool.connect(select_out, edge_index).edge_index
+    return x, edge_index, perm
+
+
+# (name, graph key, device) -> the result of a single graph, see _graph_cached, one
+# entry per mesh, level and weights, like the hierarchies kept on the device
+_graph_results = {}
+
+
+def graph_keys(b_data, hierarchies, level, weights):
+    """
+    The identity of every graph of b_data at a level of its hierarchy, for the
+    caches of cal_ew and the GCN normalization. The topology key and the level
+    identify the edges, weights where the node weights of the level come from, as
+    they differ between the encoder and the decoder: "data" for the weights of the
+    data, ones for every mesh, pooled down, and "placeholder" for those of the
+    decoder placeholders unpooled.
+    """
+    t = b_data.trajectory
+    trajectories = [t] if isinstance(t, str) else t
+    return [(hierarchies[t].key, level, weights) for t in trajectories]
+
+
+def _graph_cached(name, fn, keys, edge_index, batch, on_edges):
+    """
+    The tensors fn() computes over a batch of disjoint graphs, cached per graph
+    under its key, see graph_keys. If every graph of the batch hits, their results
+    are concatenated and fn is not run, else fn runs on the whole batch and its
+    result is split per graph. on_edges tells for every returned tensor whether it
+    is over the edges or the nodes. Without keys, fn is just run. Only for results
+    without gradients.
+    """
+    if keys is None:
+        return fn()
+    device = edge_index.device
+    entries = [_graph_results.get((name, key, device)) for key in keys]
+    if all(entry is not None for entry in entries):
+        if len(entries) == 1:
+            return entries[0]
+        return tuple(torch.cat(parts, dim=-1) for parts in zip(*entries))
+    result = fn()
+    if len(keys) == 1:
+        parts = [result]
+    else:
+        num_nodes = torch.bincount(batch, minlength=len(keys)).tolist()
+        num_edges = torch.bincount(batch[edge_index[0]], minlength=len(keys)).tolist()
+        splits = [
+            torch.split(r, num_edges if edge else num_nodes, dim=-1)
+            for r, edge in zip(result, on_edges)
+        ]
+        parts = list(zip(*splits))
+    for key, part in zip(keys, parts):
+        _graph_results[(name, key, device)] = tuple(part)
+    return result
+
+
+def _gcn_norm(edge_index, num_nodes, dtype):
+    row, col = edge_index
+    deg = degree(row, num_nodes, dtype=dtype)
+    deg_inv_sqrt = deg.pow(-0.5)
+    return deg_inv_sqrt[row] * deg_inv_sqrt[col]
+
+
 class MessagePassingEdgeConv(MessagePassing):
     def __init__(self, channel_in, channel_out, args):
         super(MessagePassingEdgeConv, self).__init__()
@@ -115,7 +221,7 @@ class GCNConv(MessagePassing):
         super(GCNConv, self).__init__(aggr="add")  # "Add" aggregation.
         self.lin = torch.nn.Linear(in_channels, out_channels)
 
-    def forward(self, b_data):
+    def forward(self, b_data, graph_keys=None):
         # x has shape [num_nodes, in_channels]
         # edge_index has shape [2, E]
         x = b_data.x
@@ -125,18 +231,22 @@ class GCNConv(MessagePassing):
         # Step 2: Linearly transform node feature matrix.
         x = self.lin(x)
 
-        # Step 3-5: Start propagating messages.
-        return self.propagate(edge_index, size=(x.size(0), x.size(0)), x=x)
-
-    def message(self, x_j, edge_index, size):
-        # x_j has shape [num_edges, out_channels]
+        # Step 3: Normalize node features, reused for the same graphs given their
+        # graph_keys, see _graph_cached
+        (norm,) = _graph_cached(
+            ("gcn_norm", x.dtype),
+            lambda: (_gcn_norm(edge_index, x.size(0), x.dtype),),
+            graph_keys,
+            edge_index,
+            b_data.batch,
+            on_edges=(True,),
+        )
 
-        # Step 3: Normalize node features.
-        row, col = edge_index
-        deg = degree(row, size[0], dtype=x_j.dtype)
-        deg_inv_sqrt = deg.pow(-0.5)
-        norm = deg_inv_sqrt[row] * deg_inv_sqrt[col]
+        # Step 4-5: Start propagating messages.
+        return self.propagate(edge_index, size=(x.size(0), x.size(0)), x=x, norm=norm)
 
+    def message(self, x_j, norm):
+        # x_j has shape [num_edges, out_channels]
         return norm.view(-1, 1) * x_j
 
     def update(self, aggr_out):
@@ -210,9 +320,21 @@ class WeightedEdgeConv(MessagePassing):
         return aggr_out
 
     @torch.no_grad()
-    def cal_ew(self, w, g):
+    def cal_ew(self, w, g, graph_keys=None, batch=None):
         if w is None:
-            w = torch.ones_like()
+            w = torch.ones(int(g.max()) + 1, device=g.device)
+        # Reused for the same graphs given their graph_keys, see _graph_cached
+        return _graph_cached(
+            "cal_ew",
+            lambda: self._cal_ew(w, g),
+            graph_keys,
+            g,
+            batch,
+            on_edges=(True, False),
+        )
+
+    @staticmethod
+    def _cal_ew(w, g):
         deg = degree(g[0], dtype=torch.float, num_nodes=w.shape[0])
         normed_w = w.squeeze(-1) / deg
         i = g[0]
@@ -295,8 +417,13 @@ class MessagePassingLayer(torch.nn.Module):
             else:
                 self.pools.append(self.pool(self.latent_dim, self.mpl_ratio))
 
-    def forward(self, b_data):
-        """Forward pass through Message Passing Layer"""
+    def forward(self, b_data, graph_keys=None):
+        """
+        Forward pass through Message Passing Layer. graph_keys identify the graphs
+        of b_data if they are a level of their hierarchies, see graph_keys, and
+        reuse the edge weights of the first level, the later levels are pooled
+        anew every forward.
+        """
         # Maybe make into a dict for readability?
         down_outs = []
         cts = []
@@ -325,7 +452,12 @@ class MessagePassingLayer(torch.nn.Module):
             # aggregate then pooling
             # Calculates edge and node weigths
             if self.args.edge_conv:
-                ew, w = self.edge_conv.cal_ew(b_data.weights, b_data.edge_index)
+                ew, w = self.edge_conv.cal_ew(
+                    b_data.weights,
+                    b_data.edge_index,
+                    graph_keys if i == 0 else None,
+                    b_data.batch,
+                )
                 b_data.weights = w
                 # Does edge convolution on nodes with edge weigths
                 b_data.x = self.edge_conv(b_data.x, b_data.edge_index, ew)
@@ -333,6 +465,10 @@ class MessagePassingLayer(torch.nn.Module):
                 cts.append(ew)
             # b_data.x = h
             if self.args.pool_strat == "ASA":
+                if is_stacked(b_data):
+                    raise NotImplementedError(
+                        "ASA pooling of feature stacked batches is not implemented"
+                    )
                 x, edge_index, edge_attr, batch, index = self.pools[i](
                     b_data.x, b_data.edge_index, b_data.edge_attr, b_data.batch
                 )
@@ -342,6 +478,14 @@ class MessagePassingLayer(torch.nn.Module):
                 b_data.edge_attr = edge_attr
                 b_data.batch = batch
                 b_data.weights = b_data.weights[index]
+            elif is_stacked(b_data):
+                x, edge_index, index = topk_pool_stacked(
+                    self.pools[i], b_data.x, b_data.edge_index
+                )
+                down_masks.append(index)
+                b_data.x = x
+                b_data.edge_index = edge_index
+                b_data.weights = b_data.weights[index]
             else:
                 # Removed edge_attr with _
                 x, edge_index, _, batch, index, _ = self.pools[i](
@@ -358,7 +502,7 @@ class MessagePassingLayer(torch.nn.Module):
             up_idx = self.l_n - i - 1
             # Unpooling
             b_data.x = self.unpools[i](
-                b_data.x, down_outs[up_idx].shape[0], down_masks[up_idx]
+                b_data.x, down_outs[up_idx].shape[-2], down_masks[up_idx]
             )
             # Old Edge
             b_data.edge_index = down_gs[up_idx]
@@ -526,7 +670,10 @@ class LatentVecLayer(nn.Module):
         # Reduce hidden dimensions to 1 for each node
         x = self.hidden_dim_mlp(x)
         # Transpose
-        b_size = len(torch.unique(b_data.batch))
+        if is_stacked(b_data):
+            b_size = x.shape[0]
+        else:
+            b_size = len(torch.unique(b_data.batch))
         x = x.view(b_size, self.max_dim)
         # x = self.batch_to_dense_transpose(b_data)
         # Reduce to latent_dim
@@ -545,8 +692,9 @@ class Unpool(nn.Module):
         super(Unpool, self).__init__()
 
     def forward(self, h, pre_node_num, idx):
-        new_h = h.new_zeros([pre_node_num, h.shape[-1]])
-        new_h[idx] = h
+        # nodes along dim -2, also for feature stacked h [B, N, F]
+        new_h = h.new_zeros([*h.shape[:-2], pre_node_num, h.shape[-1]])
+        new_h[..., idx, :] = h
         return new_h
 
 
@@ -572,7 +720,7 @@ class MeanTracker(object):
 @dataclass
 class LatentVector:
     z: torch.TensorType
-    t: list
+    t: list  # or the trajectory of all snapshots of a feature stacked batch
 
     def __iter__(self):
         return iter(zip(self.z, self.t))
@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
 """Main file for running setup, training and testing"""
+
 import argparse
 import copy
 import random
 import sys
+from itertools import islice
 
 import numpy as np
 import torch
 from loguru import logger
 from sklearn.model_selection import ParameterGrid, train_test_split
-from torch_geometric.loader import DataLoader
+from torch.utils.data import ChainDataset
 
 sys.path.append("../")
 sys.path.append("dataprocessing")
@@ -17,7 +19,12 @@ sys.path.append("model")
 sys.path.append("utils")
 from datetime import datetime
 
-from dataprocessing.dataset import MeshDataset
+from dataprocessing.dataset import MeshDataset, load_mesh_datasets
+from dataprocessing.utils.normalization import (
+    NormalizedDataLoader,
+    Normalizer,
+    split_stats,
+)
 from model.model import MultiScaleAutoEncoder
 from utils.helperfuncs import (
     decode_and_save_set,
@@ -62,13 +69,28 @@ parser.add_argument("-ae_layers", type=int, default=3)
 parser.add_argument("-alpha", type=float, default=0.5)
 parser.add_argument("-batch_size", type=int, default=2)
 parser.add_argument("-batch_norm", type=t_or_f, default=True)
+parser.add_argument(
+    "-bi_stride_pool",
+    type=t_or_f,
+    default=False,
+    help="Pool the encoder on the bi-stride hierarchy instead of with TopKPooling",
+)
 parser.add_argument("-args_file", type=none_or_str, default=None)
 parser.add_argument(
     "-data_dir", type=str, default="../data/cylinder_flow/trajectories_1768"
 )
+parser.add_argument("-dataset_manifest", type=t_or_f, default=True)
 parser.add_argument("-dual_loss", type=t_or_f, default=False)
 parser.add_argument("-epochs", type=int, default=40)
 parser.add_argument("-edge_conv", type=t_or_f, default=True)
+parser.add_argument("-h5_dir", type=str, default="../data/cylinder_flow")
+parser.add_argument(
+    "-h5_stream",
+    type=t_or_f,
+    default=False,
+    help="Stream the splits straight from the h5 files in -h5_dir instead of "
+    "loading the converted dataset in -data_dir",
+)
 parser.add_argument("-hidden_dim", type=int, default=32)
 parser.add_argument("-instance_id", type=int, default=935)
 parser.add_argument("-latent_space", type=t_or_f, default=True)
@@ -115,6 +137,22 @@ parser.add_argument(
     "-save_visualize_dir", type=str, default="../logs/visualizations/" + day
 )
 parser.add_argument("-shuffle", type=t_or_f, default=True)
+parser.add_argument(
+    "-standardize",
+    type=t_or_f,
+    default=False,
+    help="Standardize x and edge_attr with the stats of the train split, instead of "
+    "L2 normalizing x per node",
+)
+parser.add_argument(
+    "-stack_batch",
+    type=t_or_f,
+    default=False,
+    help="Stack the snapshots of a train batch as [B, N, F] over one graph, "
+    "one_traj only. TopKPooling then keeps the same nodes for the whole batch, scored "
+    "on the mean over the snapshots, so for batch_size > 1 it trains a different "
+    "pooling than the collated batches",
+)
 parser.add_argument("-save_encodings", type=t_or_f, default=False)
 parser.add_argument("-save_plot", type=t_or_f, default=True)
 parser.add_argument("-save_model", type=t_or_f, default=True)
@@ -154,30 +192,32 @@ def main(args):
         args = load_args(args)
     # Initialize dataset, containing one trajecotry.
     # NOTE: This will be changed to only take <args>
-    train_data = MeshDataset(args=args, mode="train")
-    test_data = MeshDataset(args=args, mode="test")
-    val_data = MeshDataset(args=args, mode="val")
+    if args.h5_stream and args.one_traj:
+        raise ValueError(
+            "-h5_stream streams whole splits, it can't be used with -one_traj"
+        )
+    train_data, test_data, val_data = load_mesh_datasets(
+        args, modes=["train", "test", "val"], stream=args.h5_stream
+    )
+    g = train_data.first_graph() if args.h5_stream else train_data[0]
     args.in_dim_node, args.in_dim_edge, args.n_nodes = (
-        train_data[0].num_features,
-        train_data[0].edge_attr.shape[1],
-        train_data[0].x.shape[0],
+        g.num_features,
+        g.edge_attr.shape[1],
+        g.x.shape[0],
     )
     (
-        m_ids,
-        m_gs,
-        e_s,
-        m_pos,
+        hierarchies,
         args.max_latent_nodes,
         args.max_latent_edges,
         graph_placeholders,
     ) = merge_dataset_stats(train_data, test_data, val_data)
 
-    save_graph_structure(args, m_ids, m_gs, e_s, m_pos, graph_placeholders)
+    save_graph_structure(args, hierarchies, graph_placeholders)
 
     # args.latent_vec_dim = math.ceil(dataset[0].num_nodes*(args.ae_ratio**args.ae_layers))
     # Initialize Model
 
-    model = MultiScaleAutoEncoder(args, m_ids, m_gs, e_s, m_pos, graph_placeholders)
+    model = MultiScaleAutoEncoder(args, hierarchies, graph_placeholders)
     model = model.to(args.device)
     if args.load_model:
         model = load_model(args, model)
@@ -199,19 +239,40 @@ def main(args):
             test_size=args.val_ratio / (1 - args.test_ratio),
             random_state=seed,
         )
-    val_data.sort(key=lambda g: g.t)
+    if isinstance(val_data, MeshDataset):
+        val_data = val_data[val_data.time_order]
+    elif not args.h5_stream:
+        val_data.sort(key=lambda g: g.t)
+
+    # Batches are normalized by the loaders, with the stats of the split trained on
+    stats = None
+    if args.standardize:
+        if isinstance(train_data, MeshDataset):
+            stats = train_data.stats(args.num_workers)
+        else:
+            stats = split_stats(train_data)
+    normalizer = Normalizer(stats)
 
-    logger.info(
-        f"\n\tTrain size : {len(train_data)}, \n\
+    logger.info(f"\n\tTrain size : {len(train_data)}, \n\
         Validation size : {len(val_data)}, \n\
-        Test size : {len(test_data)}"
-    )
+        Test size : {len(test_data)}")
     # Create Dataloaders for train, test and validation
-    train_loader = DataLoader(
-        train_data, batch_size=args.batch_size, shuffle=args.shuffle
+    if args.stack_batch and not args.one_traj:
+        raise ValueError(
+            "-stack_batch needs the snapshots of one trajectory, -one_traj"
+        )
+    train_loader = NormalizedDataLoader(
+        train_data,
+        normalizer,
+        stack=args.stack_batch,
+        batch_size=args.batch_size,
+        # The stream shuffles itself
+        shuffle=args.shuffle and not args.h5_stream,
+    )
+    val_loader = NormalizedDataLoader(val_data, normalizer, batch_size=1, shuffle=False)
+    test_loader = NormalizedDataLoader(
+        test_data, normalizer, batch_size=1, shuffle=False
     )
-    val_loader = DataLoader(val_data, batch_size=1, shuffle=False)
-    test_loader = DataLoader(test_data, batch_size=1, shuffle=False)
     logger.success("All data loaded")
 
     # TRAINING
@@ -231,18 +292,23 @@ def main(args):
     save_loss_ts_as_np(args, ts, loss_ts)
     plot_test_loss(ts, loss_ts, args, PATH=args.save_loss_over_t_dir)
 
-    # extend the list and sort it with regards to t
-    train_data.extend(val_data)
-    train_data.extend(test_data)
-    test_data.sort(key=lambda g: g.t)
+    if args.h5_stream:
+        gif_data = list(islice(test_data, 80))
+        train_data = ChainDataset([train_data, val_data, test_data])
+    else:
+        # extend the list and sort it with regards to t
+        train_data.extend(val_data)
+        train_data.extend(test_data)
+        test_data.sort(key=lambda g: g.t)
+        gif_data = test_data[:80]
     if args.make_gif:
-        make_gif(model, test_data[:80], args)
+        make_gif(model, gif_data, args, normalizer)
     if args.save_encodings:
         logger.info("Encoding graphs")
         encoder = model.encoder.to(args.device)
         # save_pair_encodings(args, encoder)
-        encode_and_save_set(args, encoder, train_data)
-    decode_and_save_set(args, model.decoder.to(args.device), train_data)
+        encode_and_save_set(args, encoder, train_data, normalizer)
+    decode_and_save_set(args, model.decoder.to(args.device), train_data, normalizer)
     # write_average_accuracy(args, loss_ts)
 
 
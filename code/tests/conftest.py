@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tests import the packages of code/, as the run scripts do
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
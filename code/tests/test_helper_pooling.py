@@ -0,0 +1,64 @@
+import numpy as np
+import scipy
+from scipy.spatial import Delaunay
+
+from dataprocessing.utils.helper_pooling import (
+    _adj_mat_to_flat_edge,
+    bstride_selection,
+    pool_edge,
+)
+from dataprocessing.utils.triangle_to_edges import triangles_to_edges
+
+N_NODES = 400
+
+
+def mesh():
+    """The two-way edges [2, E] and positions of a Delaunay mesh of N_NODES nodes."""
+    rng = np.random.default_rng(0)
+    points = rng.random((N_NODES, 2))
+    return np.stack(triangles_to_edges(Delaunay(points).simplices)), points
+
+
+def squared_adjacency(edges):
+    # As bstride_selection builds it, with explicit zeros left on the diagonal
+    adj = scipy.sparse.coo_array(
+        (np.ones(edges.shape[1]), (edges[0], edges[1])), shape=(N_NODES, N_NODES)
+    ).tocsr()
+    adj.setdiag(1)
+    adj = adj @ adj
+    adj.setdiag(0)
+    return adj
+
+
+def test_adj_mat_to_flat_edge_sparse_matches_dense():
+    adj = squared_adjacency(mesh()[0])
+    dense = _adj_mat_to_flat_edge(adj.toarray())
+    np.testing.assert_array_equal(_adj_mat_to_flat_edge(adj), dense)
+    # Unsorted COO with duplicate entries lists every edge once, in the same order
+    coo = adj.tocoo()
+    perm = np.random.default_rng(1).permutation(coo.nnz)
+    row = np.concatenate([coo.row[perm], coo.row[:10]])
+    col = np.concatenate([coo.col[perm], coo.col[:10]])
+    data = np.concatenate([coo.data[perm], coo.data[:10]])
+    unsorted = scipy.sparse.coo_array((data, (row, col)), shape=adj.shape)
+    np.testing.assert_array_equal(_adj_mat_to_flat_edge(unsorted), dense)
+
+
+def test_pool_edge_sparse_matches_dense():
+    adj = squared_adjacency(mesh()[0])
+    rng = np.random.default_rng(2)
+    # Kept nodes in arbitrary order, their position is the new node id
+    idx = rng.choice(N_NODES, size=N_NODES // 2, replace=False)
+    g, e_idx = pool_edge(adj, idx, N_NODES)
+    dense_g, dense_e_idx = pool_edge(adj.toarray(), idx, N_NODES)
+    np.testing.assert_array_equal(g, dense_g)
+    np.testing.assert_array_equal(e_idx, dense_e_idx)
+    assert g.shape[1] > 0 and g.max() < len(idx)
+
+
+def test_bstride_selection_pools_edges_of_kept_nodes():
+    edges, pos = mesh()
+    idx, g, e_idx = bstride_selection(edges, N_NODES, pos)
+    dense_g, dense_e_idx = pool_edge(squared_adjacency(edges).toarray(), idx, N_NODES)
+    np.testing.assert_array_equal(g, dense_g)
+    np.testing.assert_array_equal(e_idx, dense_e_idx)
@@ -0,0 +1,52 @@
+import os
+
+import h5py
+import numpy as np
+import pytest
+from scipy.spatial import Delaunay
+
+from dataprocessing.utils.triangle_to_edges import (
+    NodeType,
+    one_hot,
+    tf_triangles_to_edges,
+    triangles_to_edges,
+)
+
+tf = pytest.importorskip("tensorflow")
+
+H5_FILE = os.path.join(
+    os.path.dirname(__file__), "..", "data", "cylinder_flow", "train.h5"
+)
+
+
+def mesh_cells_and_types():
+    """
+    The cells and node types of the first trajectory of the cylinder_flow train set
+    when it is present, otherwise of a Delaunay mesh of random points with the
+    node types of cylinder_flow.
+    """
+    if os.path.isfile(H5_FILE):
+        with h5py.File(H5_FILE, "r") as data:
+            traj = data[next(iter(data.keys()))]
+            return traj["cells"][0], traj["node_type"][0]
+    rng = np.random.default_rng(0)
+    points = rng.random((300, 2))
+    cells = rng.permutation(Delaunay(points).simplices).astype(np.int32)
+    node_type = rng.choice([0, 4, 5, 6], size=(len(points), 1)).astype(np.int32)
+    return cells, node_type
+
+
+def test_triangles_to_edges_matches_tf():
+    cells, _ = mesh_cells_and_types()
+    senders, receivers = triangles_to_edges(cells)
+    tf_senders, tf_receivers = tf_triangles_to_edges(tf.convert_to_tensor(cells))
+    # Same edges in the same order, not only the same edge set
+    np.testing.assert_array_equal(senders, tf_senders.numpy())
+    np.testing.assert_array_equal(receivers, tf_receivers.numpy())
+
+
+def test_one_hot_matches_tf():
+    _, node_type = mesh_cells_and_types()
+    for depth in [NodeType.SIZE, NodeType.WALL_BOUNDARY + 1]:
+        expected = tf.one_hot(node_type, depth).numpy()
+        np.testing.assert_array_equal(one_hot(node_type, depth), expected)
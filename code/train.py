@@ -56,6 +56,9 @@ def train(model, train_loader, val_loader, args):
                 leave=False,
                 position=True,
             )
+        # H5StreamDataset reshuffles its windows per epoch
+        if hasattr(train_loader.dataset, "set_epoch"):
+            train_loader.dataset.set_epoch(epoch)
         total_loss = 0
         model.train()
         for idx, batch in enumerate(train_loader):
@@ -68,7 +71,7 @@ def train(model, train_loader, val_loader, args):
             batch = batch.to(args.device)
             b_data = batch.clone()
             pred, kl = model(b_data)
-            mask = batch.x[:, 0] < 0.0
+            mask = batch.x[..., 0] < 0.0
             rec_loss_node = criterion(pred.x, batch.x)
             mask_loss_node = criterion(pred.x[mask], batch.x[mask])
             loss = beta * kl + rec_loss_node + alpha * mask_loss_node
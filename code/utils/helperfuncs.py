@@ -7,7 +7,9 @@ from random import randint
 import numpy as np
 import torch
 from dataprocessing.dataset import DatasetPairs
+from dataprocessing.utils.hierarchy import save_graph_structure_bundle
 from dataprocessing.utils.loading import save_traj_pairs
+from dataprocessing.utils.normalization import NormalizedDataLoader, Normalizer
 from loguru import logger
 from model.utility import LatentVector
 from torch import optim
@@ -40,18 +42,16 @@ def create_folder(path):
         logger.info(f"created folder at {path}")
 
 
-def save_graph_structure(args, m_ids, m_gs, e_s, m_pos, graph_placeholders):
+def save_graph_structure(args, hierarchies, graph_placeholders):
     create_folder(args.graph_structure_dir)
     PATH = os.path.join(args.graph_structure_dir, f"{args.instance_id}")
     create_folder(PATH)
     PATH = os.path.join(PATH, f"{args.ae_layers}")
     create_folder(PATH)
-    # These five save operations took 0.15 seconds, thus it's okay we override them everytime
-    torch.save(m_ids, os.path.join(PATH, "m_ids.pt"))
-    torch.save(m_gs, os.path.join(PATH, "m_gs.pt"))
-    torch.save(e_s, os.path.join(PATH, "e_s.pt"))
-    torch.save(m_pos, os.path.join(PATH, "m_pos.pt"))
-    torch.save(graph_placeholders, os.path.join(PATH, "graph_placeholders.pt"))
+    # One bundle, every mesh stored once, loaded with load_graph_structure
+    save_graph_structure_bundle(
+        os.path.join(PATH, "graph_structure.pt"), hierarchies, graph_placeholders
+    )
 
 
 def create_encodings_folders(args):
@@ -105,7 +105,7 @@ def save_pair_encodings(args, encoder):
 
 
 @torch.no_grad()
-def encode_and_save_set(args, encoder, dataset):
+def encode_and_save_set(args, encoder, dataset, normalizer=None):
     logger.info("encoding graphs from  with current model...")
     PATH = create_encodings_folders(args)
     pair_list_file = os.path.join(PATH, "encoded_dataset.pt")
@@ -113,7 +113,9 @@ def encode_and_save_set(args, encoder, dataset):
         os.remove(pair_list_file)
 
     pair_list = []
-    loader = DataLoader(dataset, batch_size=1)
+    if normalizer is None:
+        normalizer = Normalizer()
+    loader = NormalizedDataLoader(dataset, normalizer, batch_size=1)
     start_time = time.time()
     for idx, graph in enumerate(loader):
         _, z, _ = encoder(graph.clone().to(args.device))
@@ -132,7 +134,9 @@ def encode_and_save_set(args, encoder, dataset):
     logger.success(f"Encodings saved at {pair_list_file}")
 
 
-def decode_and_save_set(args, decoder, dataset):
+def decode_and_save_set(args, decoder, dataset, normalizer=None):
+    # The latent vectors decode to the space of the normalized graphs, normalizer
+    # is taken for symmetry with encode_and_save_set
     logger.info("decoding graph")
     PATH = create_encodings_folders(args)
     encoded_list_file = os.path.join(PATH, "encoded_dataset.pt")
@@ -253,27 +257,15 @@ def merge_dataset_stats(train, val, test):
     graph_placeholders = Merge(
         Merge(train.graph_placeholders, test.graph_placeholders), val.graph_placeholders
     )
-    train_id, train_g, train_e, train_pos = train._get_pool()
-    test_id, test_g, test_e, test_pos = test._get_pool()
-    val_id, val_g, val_e, val_pos = val._get_pool()
-    m_ids, m_gs, e_s, m_pos = [], [], [], []
+    hierarchies = Merge(Merge(train._get_pool(), test._get_pool()), val._get_pool())
     max_latent_nodes = max(
         [train.max_latent_nodes, test.max_latent_nodes, val.max_latent_nodes]
     )
     max_latent_edges = max(
         [train.max_latent_edges, test.max_latent_edges, val.max_latent_edges]
     )
-    for i in range(len(train_id)):
-        m_ids.append(Merge(Merge(train_id[i], test_id[i]), val_id[i]))
-        e_s.append(Merge(Merge(train_e[i], test_e[i]), val_e[i]))
-    for i in range(len(train_g)):
-        m_gs.append(Merge(Merge(train_g[i], test_g[i]), val_g[i]))
-        m_pos.append(Merge(Merge(train_pos[i], test_pos[i]), val_pos[i]))
     return (
-        m_ids,
-        m_gs,
-        e_s,
-        m_pos,
+        hierarchies,
         max_latent_nodes,
         max_latent_edges,
         graph_placeholders,
@@ -11,13 +11,16 @@ import umap.umap_ as umap
 from loguru import logger
 from matplotlib import animation
 from matplotlib import tri as mtri
-from model.decoder import Decoder
-from model.utility import LatentVector
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from sklearn.manifold import TSNE
 from torch_geometric.data import Batch
 from torch_geometric.loader import DataLoader
 from torch_geometric.utils import to_networkx
+
+from dataprocessing.utils.hierarchy import load_graph_structure
+from dataprocessing.utils.normalization import Normalizer
+from model.decoder import Decoder
+from model.utility import LatentVector
 from utils.helperfuncs import create_folder
 
 
@@ -187,8 +190,12 @@ def make_animation(
         pass
 
 
-def make_gif(model, dataset, args):
+def make_gif(model, dataset, args, normalizer=None):
     logger.info("Making gif...:")
+    if normalizer is None:
+        normalizer = Normalizer()
+    # Ground truth in the normalized space the model reconstructs
+    dataset = [normalizer(g.clone()) for g in dataset]
     PRED = copy.deepcopy(dataset)
     GT = copy.deepcopy(dataset)
     DIFF = copy.deepcopy(dataset)
@@ -520,14 +527,10 @@ def deformater_visualize(deformator, validation_loader, args):
         f"{args.instance_id}",
         f"{args.ae_layers}",
     )
-    m_ids, m_gs, e_s, m_pos, graph_placeholders = (
-        torch.load(os.path.join(PATH, "m_ids.pt")),
-        torch.load(os.path.join(PATH, "m_gs.pt")),
-        torch.load(os.path.join(PATH, "e_s.pt")),
-        torch.load(os.path.join(PATH, "m_pos.pt")),
-        torch.load(os.path.join(PATH, "graph_placeholders.pt")),
+    hierarchies, graph_placeholders = load_graph_structure(
+        os.path.join(PATH, "graph_structure.pt")
     )
-    decoder = Decoder(args, m_ids, m_gs, e_s, m_pos, graph_placeholders).to(args.device)
+    decoder = Decoder(args, hierarchies, graph_placeholders).to(args.device)
     decoder.load_state_dict(torch.load(args.decoder_path))
     if args.decode_single_test:
         # decodes and saves a single graph